@@ -10,6 +10,7 @@ class DefaultValues():
     TESTRUN_GENOMES = os.path.join(os.path.dirname(__file__), 'testrun')
 
     PRODIGAL_FOLDER_NAME = 'protein_files'
+    GENE_FILES_FOLDER_NAME = 'gene_files'
 
     #LOGNAME = 'log.txt'
 
@@ -19,16 +20,44 @@ class DefaultValues():
     DIAMOND_EVALUE = 1e-05
 
     DIAMOND_DEFAULT_CHUNK_SIZE = 500
+    # chunks run concurrently only if each gets at least this many threads
+    DIAMOND_MIN_CHUNK_THREADS = 4
+    # DIAMOND needs roughly this many GB of memory per unit of --block-size, by number of --index-chunks
+    DIAMOND_MEMORY_PER_BLOCK_SIZE_GB = {1: 18, 2: 10, 4: 6}
+    DIAMOND_DEFAULT_INDEX_CHUNKS = 4
+    DIAMOND_DEFAULT_BLOCK_SIZE = 2
+    DIAMOND_LOWMEM_BLOCK_SIZE = 0.5
+    DIAMOND_MIN_BLOCK_SIZE = 0.1
+    DIAMOND_MAX_BLOCK_SIZE = 20
+
+    # memory kept free for the models under --memory_limit, and estimated memory per genome feature vector
+    MODEL_MEMORY_RESERVE_GB = 2
+    FEATURE_VECTOR_MEMORY_MB = 2
 
     KO_FEATURE_VECTOR_CHUNK = 250
 
+    # sequence files are read in blocks of this size
+    SEQUENCE_READ_BLOCK_MB = 4
+
     DIAMOND_HEADER_SEPARATOR = 'Ω'
     
     AA_RATIO_COMPLETENESS_CUTOFF = 1500
 
+    # with --ttable_prescreen, genes are only called with translation table 4 if table 11 coding density is below
+    # TTABLE_SCREEN_CODING_DENSITY, or if reading through the TGA stop codons of table 11 genes brings coding density
+    # within TTABLE_SCREEN_MARGIN of the thresholds for choosing table 4. These values have not yet been tuned on
+    # real genomes (e.g. a --dbg_ttable run on a reference panel including Mycoplasma and Spiroplasma), which is
+    # why the pre-screen is off by default
+    TTABLE_SCREEN_CODING_DENSITY = 0.8
+    TTABLE_SCREEN_MARGIN = 0.02
+
     MODEL_DIVERGENCE_WARNING_THRESHOLD = 25
 
+    GENOME_CACHE_MAX_SIZE_GB = 10
+    PROTEIN_CACHE_FILE_NAME = 'protein_annotations.sqlite'
+
     DB_LOCATION_DEFINITION = os.path.join(VERSION_PATH, 'diamond_path.json')
+    PRUNED_DB_REGISTRY = os.path.join(VERSION_PATH, 'pruned_databases.json')
     DB_VAR = "CHECKM2DB"
     try:
         DEFAULT_DB_INSTALL_LOCATION = os.path.join(str(Path.home()), 'databases')
@@ -39,9 +68,21 @@ class DefaultValues():
     FEATURE_ORDER_LOCATION = os.path.join(DATA_PATH, 'feature_ordering.json')
     PATH_CATEGORY_MAPPING_LOCATION = os.path.join(DATA_PATH, 'kegg_path_category_mapping.json')
     MODULE_DEFINITION_LOCATION = os.path.join(DATA_PATH, 'module_definitions.json')
+    FEATURE_SCHEMA_LOCATION = os.path.join(DATA_PATH, 'feature_schema.npz')
 
     GENERAL_MODEL_COMP_LOCATION = os.path.join(MODEL_PATH, 'general_model_COMP.gbm')
     SPECIFIC_MODEL_COMP_LOCATION = os.path.join(MODEL_PATH, 'specific_model_COMP.hd5')
+    # NumPy export of the specific model, used instead of Keras when present
+    SPECIFIC_MODEL_NUMPY_LOCATION = os.path.join(MODEL_PATH, 'specific_model_COMP.npz')
+    NUMPY_NETWORK_FLOAT32 = False
+    NUMPY_NETWORK_BATCH_MB = 256
+    # largest allowed difference to Keras, in completeness percentage points
+    NUMPY_NETWORK_TOLERANCE = 1e-3
+    # random feature vectors used to check converted models
+    MODEL_CHECK_SAMPLES = 1000
+    MODEL_BENCHMARK_GENOMES = 10000
+    # all models and the reference index in one memory-mapped file, used instead of the files above when present
+    MODEL_BUNDLE_LOCATION = os.path.join(MODEL_PATH, 'checkm2_models.bundle')
 
     MODEL_CONT_LOCATION = os.path.join(MODEL_PATH, 'model_CONT.gbm')
 #    SPECIFIC_MODEL_CONT_LOCATION = os.path.join(MODEL_PATH, 'specific_model_CONT.hd5')
@@ -49,6 +90,12 @@ class DefaultValues():
     SCALER_FILE_LOCATION = os.path.join(MODEL_PATH, 'scaler.sav')
     COSINE_TABLE_LOCATION = os.path.join(MODEL_PATH, 'cosine_table.pkl')
     REF_DATA_LOCATION = os.path.join(DATA_PATH, 'min_ref_rsdata_v1.npz')
+    REF_INDEX_LOCATION = os.path.join(DATA_PATH, 'reference_index')
+    # bounds the memory used by one block of the reference similarity query
+    REF_QUERY_BLOCK_MB = 256
+    # approximate reference search: clusters searched per query, and k-means iterations used to build clusters
+    REF_ANN_PROBES = 8
+    REF_ANN_ITERATIONS = 10
 
     EXTERNAL_FILES_TO_VERIFY = [FEATURE_ORDER_LOCATION, PATH_CATEGORY_MAPPING_LOCATION,
                                 MODULE_DEFINITION_LOCATION, GENERAL_MODEL_COMP_LOCATION,
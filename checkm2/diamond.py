@@ -1,4 +1,6 @@
 from checkm2 import fileManager
+from checkm2 import versionControl
+from checkm2.resourcePlanner import ResourcePlanner
 from checkm2.defaultValues import DefaultValues
 from checkm2 import sequenceClasses
 from checkm2 import keggData
@@ -6,17 +8,20 @@ from checkm2 import keggData
 import subprocess
 import os
 import sys
-from functools import reduce
+import hashlib
 import tempfile
 import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+from scipy import sparse
 
 
 '''Diamond only accepts single inputs, so we concat protein files and chunk them as input using tempfile'''
 
 class DiamondRunner():
 
-    def __init__(self, threads, output_directory, lowmem, diamond_location):
+    def __init__(self, threads, output_directory, lowmem, diamond_location, annotation_cache=None, planner=None):
         self.threads = threads
 
         self.chunksize = DefaultValues.DIAMOND_DEFAULT_CHUNK_SIZE
@@ -25,16 +30,21 @@ class DiamondRunner():
         self.subject_cover = DefaultValues.DIAMOND_SUBJECT_COVER
         self.id = DefaultValues.DIAMOND_PERCENT_ID
         self.separator = DefaultValues.DIAMOND_HEADER_SEPARATOR
-        if lowmem:
-            self.blocksize = 0.5
-        else:
-            self.blocksize = 2
-
         self.check_for_diamond()
         self.diamond_out = os.path.join(output_directory, "diamond_output")
         fileManager.make_sure_path_exists(self.diamond_out)
         self.diamond_location = diamond_location
 
+        # block size and index chunks are set from a memory budget, see ResourcePlanner
+        self.planner = planner if planner is not None else ResourcePlanner(threads, diamond_location, lowmem)
+        self.plan([], log=False)
+
+        # pruned databases report E-values against the size of the full database they were built from
+        self.dbsize = versionControl.VersionControl().return_pruned_DIAMOND_size(diamond_location)
+
+        # optional ProteinAnnotationCache; only proteins not found in it are searched with DIAMOND
+        self.annotation_cache = annotation_cache
+
 
     def check_for_diamond(self):
         """Check to see if Diamond is on the system before we try to run it."""
@@ -56,75 +66,208 @@ class DiamondRunner():
         # fileManager.check_if_file_exists(self.diamond_location)
 
 
-    def __concatenate_proteins(self, file_list):
-        seq_list = []
+    def __write_query(self, file_list, query):
+        '''Stream protein files into a single DIAMOND query file, one record at a time.
+
+        Headers are prefixed with the genome name using the pre-defined separator. Identical proteins (e.g. from
+        strain-level bins or co-assemblies) are only written once, and proteins found in the annotation cache are
+        not written at all. Returns the duplicates of each written or cached representative, the cached hits and
+        the sequence hashes of the written proteins (the latter two only with an annotation cache).'''
+
+        # sha256 digest of each distinct sequence -> header of its first occurrence
+        representatives = {}
+        duplicates = {}
+        cached_hits = {}
+        searched = {}
+        total = 0
+
         for faa in file_list:
             basename = os.path.splitext(os.path.basename(faa))[0]
-            parsed_faa = sequenceClasses.SeqReader().read_nucleotide_sequences(faa)
-
-            #append name to contig name using pre-defined separator to construct a new dict key
-            parsed_faa = dict(("{}{}{}".format(basename, self.separator, k), v) for k, v in parsed_faa.items())
-            seq_list.append(parsed_faa)
-
-        return reduce(lambda a, b: {**a, **b}, seq_list)
-
-    def __call_diamond(self, seq_object, diamond_output):
-        with tempfile.NamedTemporaryFile() as temp_diamond_input:
-
-            sequenceClasses.SeqReader().write_fasta(seq_object, temp_diamond_input.name)
-
-            diamond_working_dir = tempfile.TemporaryDirectory()
-
-            try:
-                cmd = "diamond blastp --outfmt 6 --max-target-seqs 1 " \
-                      "--query {} " \
-                      "-o {} " \
-                      "--threads {} " \
-                      "--db {} " \
-                      "--query-cover {} " \
-                      "--subject-cover {} " \
-                      "--id {} " \
-                      "--evalue {} --block-size {} "\
-                      "--tmpdir {} --quiet "\
-                    .format(temp_diamond_input.name,
-                            diamond_output,
-                            self.threads,
-                            self.diamond_location,
-                            DefaultValues.DIAMOND_QUERY_COVER,
-                            DefaultValues.DIAMOND_SUBJECT_COVER,
-                            DefaultValues.DIAMOND_PERCENT_ID,
-                            DefaultValues.DIAMOND_EVALUE,
-                            float(self.blocksize),
-                            diamond_working_dir.name)
-
-                logging.debug(cmd)
-                subprocess.check_call(cmd, shell=True)
-                logging.debug('Finished Running DIAMOND')
-            except Exception as e:
-                logging.error('An error occured while running DIAMOND: {}'.format(e))
-                sys.exit(1)
-            finally:
-                diamond_working_dir.cleanup()
-                temp_diamond_input.close()
 
+            # with an annotation cache, the new proteins of one genome are held so cache lookups can be batched
+            genome_records = []
+            for name, seq, _ in sequenceClasses.SeqFileReader(faa).records():
+                header = "{}{}{}".format(basename, self.separator, name)
+                seq_digest = hashlib.sha256(seq.encode()).digest()
+                total += 1
+
+                representative = representatives.setdefault(seq_digest, header)
+                if representative != header:
+                    duplicates.setdefault(representative, []).append(header)
+                elif self.annotation_cache is None:
+                    query.write('>{}\n{}\n'.format(header, seq))
+                else:
+                    genome_records.append((header, seq_digest.hex(), seq))
+
+            if len(genome_records) == 0:
+                continue
+
+            # cached proteins are keyed by the hexadecimal sequence hash
+            found = self.annotation_cache.lookup(set(seq_hash for _, seq_hash, _ in genome_records))
+
+            for header, seq_hash, seq in genome_records:
+                if seq_hash in found:
+                    if found[seq_hash] is not None:
+                        cached_hits[header] = found[seq_hash]
+                else:
+                    query.write('>{}\n{}\n'.format(header, seq))
+                    searched[header] = seq_hash
+
+        if total > 0:
+            logging.info('Searching {} unique of {} proteins ({:.2f}% duplicates removed).'.format(
+                len(representatives), total, 100 * (1 - len(representatives) / total)))
+        if self.annotation_cache is not None:
+            logging.info('Found {} of {} proteins in the protein annotation cache.'.format(
+                len(representatives) - len(searched), len(representatives)))
+
+        return duplicates, cached_hits, searched
+
+    def __call_diamond(self, file_list, diamond_output, threads=None):
+        with tempfile.NamedTemporaryFile('w') as temp_diamond_input:
+            duplicates, cached_hits, searched = self.__write_query(file_list, temp_diamond_input)
+            temp_diamond_input.flush()
+
+            if self.annotation_cache is None or len(searched) > 0:
+                self.__run_blastp(temp_diamond_input.name, diamond_output, threads)
+
+        if self.annotation_cache is not None:
+            self.__update_cache(diamond_output, searched, cached_hits)
+
+        if len(duplicates) > 0:
+            self.__fan_out_hits(diamond_output, duplicates)
+
+    def __fan_out_hits(self, diamond_output, duplicates):
+        '''Copy the hits of each representative protein to all proteins with an identical sequence.'''
+
+        with open(diamond_output) as diamond_results:
+            representative_hits = [line.split('\t', 1) for line in diamond_results
+                                   if line.split('\t', 1)[0] in duplicates]
+
+        with open(diamond_output, 'a') as diamond_results:
+            for representative, hit in representative_hits:
+                for header in duplicates[representative]:
+                    diamond_results.write('{}\t{}'.format(header, hit))
+
+    def __update_cache(self, diamond_output, searched, cached_hits):
+        '''Store the hits of newly searched proteins and add cached hits to DIAMOND's own results.'''
+
+        if len(searched) > 0:
+            new_hits = {}
+            with open(diamond_output) as diamond_results:
+                for line in diamond_results:
+                    header, hit = line.rstrip('\n').split('\t', 1)
+                    # keep every line DIAMOND reported for a query
+                    new_hits[header] = hit if header not in new_hits else '{}\n{}'.format(new_hits[header], hit)
+
+            self.annotation_cache.store(dict((seq_hash, new_hits.get(header)) for header, seq_hash in searched.items()))
+
+        # cached hits use the same tabular format
+        with open(diamond_output, 'a') as diamond_results:
+            for header, hits in cached_hits.items():
+                for hit in hits.split('\n'):
+                    diamond_results.write('{}\t{}\n'.format(header, hit))
+
+    def __run_blastp(self, diamond_input, diamond_output, threads=None):
+        diamond_working_dir = tempfile.TemporaryDirectory()
+
+        try:
+            cmd = "diamond blastp --outfmt 6 --max-target-seqs 1 " \
+                  "--query {} " \
+                  "-o {} " \
+                  "--threads {} " \
+                  "--db {} " \
+                  "--query-cover {} " \
+                  "--subject-cover {} " \
+                  "--id {} " \
+                  "--evalue {} --block-size {} "\
+                  "--tmpdir {} --quiet "\
+                .format(diamond_input,
+                        diamond_output,
+                        self.threads if threads is None else threads,
+                        self.diamond_location,
+                        DefaultValues.DIAMOND_QUERY_COVER,
+                        DefaultValues.DIAMOND_SUBJECT_COVER,
+                        DefaultValues.DIAMOND_PERCENT_ID,
+                        DefaultValues.DIAMOND_EVALUE,
+                        float(self.blocksize),
+                        diamond_working_dir.name)
+            if self.index_chunks is not None:
+                cmd += "--index-chunks {} ".format(self.index_chunks)
+            if self.dbsize is not None:
+                cmd += "--dbsize {} ".format(self.dbsize)
+
+            logging.debug(cmd)
+            subprocess.check_call(cmd, shell=True)
+            logging.debug('Finished Running DIAMOND')
+        except Exception as e:
+            logging.error('An error occured while running DIAMOND: {}'.format(e))
+            sys.exit(1)
+        finally:
+            diamond_working_dir.cleanup()
+
+
+    def __residues(self, protein_files, residues=None):
+        '''Residue counts of protein files from the genome metadata if available, otherwise their file sizes.'''
+
+        weights = []
+        for faa in protein_files:
+            name = os.path.splitext(os.path.basename(faa))[0]
+            weights.append(residues[name] if residues is not None and name in residues else os.path.getsize(faa))
+        return weights
+
+    def __balance_chunks(self, protein_files, residues=None):
+        '''Split protein files into as many chunks as chunks of 'chunksize' genomes would give, but with roughly
+        equal numbers of residues, so that chunks take similar time.'''
+
+        weights = self.__residues(protein_files, residues)
+        chunk_count = -(-len(protein_files) // self.chunksize)
+        target = sum(weights) / chunk_count
+
+        chunk_list, chunk, cumulative = [], [], 0
+        for faa, weight in zip(protein_files, weights):
+            chunk.append(faa)
+            cumulative += weight
+            if cumulative >= target * (len(chunk_list) + 1) and len(chunk_list) < chunk_count - 1:
+                chunk_list.append(chunk)
+                chunk = []
+        if len(chunk) > 0:
+            chunk_list.append(chunk)
 
-    def run(self, protein_files):
+        return chunk_list
+
+    def plan(self, chunk_residues, log=True):
+        '''Set block size and index chunks for chunks of the given residue counts and return the full plan.'''
+
+        plan = self.planner.plan_diamond(chunk_residues, log)
+        self.blocksize = plan['block_size']
+        self.index_chunks = plan['index_chunks']
+        return plan
+
+    def run(self, protein_files, residues=None):
 
         
         logging.info('Annotating input genomes with DIAMOND using {} threads'.format(self.threads))
         
         if len(protein_files) <= self.chunksize:
-            protein_chunks = self.__concatenate_proteins(protein_files)
+            self.plan([sum(self.__residues(protein_files, residues))])
             diamond_out = os.path.join(self.diamond_out, "DIAMOND_RESULTS.tsv")
-            self.__call_diamond(protein_chunks, diamond_out)
+            self.__call_diamond(protein_files, diamond_out)
                         
         else:
-            #break file list into chunks of size 'chunksize'
-            chunk_list = [protein_files[i:i + self.chunksize] for i in range(0, len(protein_files), self.chunksize)]
-            
-            for number, chunk in enumerate(chunk_list):
-                diamond_out = os.path.join(self.diamond_out, "DIAMOND_RESULTS_{}.tsv".format(number))
-                self.__call_diamond(self.__concatenate_proteins(chunk), diamond_out)
+            chunk_list = self.__balance_chunks(protein_files, residues)
+            plan = self.plan([sum(self.__residues(chunk, residues)) for chunk in chunk_list])
+
+            with ThreadPoolExecutor(max_workers=plan['concurrency']) as executor:
+                chunk_jobs = [executor.submit(self.run_chunk, chunk, number, plan['chunk_threads'])
+                              for number, chunk in enumerate(chunk_list)]
+                try:
+                    for job in chunk_jobs:
+                        job.result()
+                except BaseException:
+                    # don't start the remaining chunks if one of them failed
+                    for job in chunk_jobs:
+                        job.cancel()
+                    raise
 
         
         diamond_out_list = [x for x in os.listdir(self.diamond_out) if x.startswith('DIAMOND_RESULTS')]
@@ -136,34 +279,75 @@ class DiamondRunner():
 
 
 
-    def process_diamond_output(self, defaultKOs, annot_dict, chunk_name_list):
+    def run_chunk(self, protein_files, number, threads=None):
+        '''Annotate a single chunk of protein files, e.g. while gene calling for later chunks is still running.'''
 
-        KeggCalc = keggData.KeggCalculator()
+        logging.debug('Annotating chunk {} ({} genomes) with DIAMOND using {} threads'.format(
+            number, len(protein_files), self.threads if threads is None else threads))
 
-        kegg_genome_list = []
-        
-        for genome in chunk_name_list:
-            sub_dict = defaultKOs.copy()
-            sub_dict['Name'] = genome
+        diamond_out = os.path.join(self.diamond_out, "DIAMOND_RESULTS_{}.tsv".format(number))
+        self.__call_diamond(protein_files, diamond_out, threads)
 
-            #valid diamond annotations found
-            if genome in annot_dict.keys():
-                diamond_KO_subset = annot_dict[genome]['Kegg_annotation'].value_counts()
-                sub_dict.update(diamond_KO_subset)
-            
-            kegg_genome_list.append(sub_dict)
+        return os.path.basename(diamond_out)
 
-        KO_genes = pd.DataFrame(kegg_genome_list)
+    def build_KO_matrix(self, diamond_out_list, genome_names, KO_list, cached_KO_counts=None):
+        '''Count DIAMOND hits into a sparse genomes x KOs matrix with rows in the order of genome_names and columns
+        in the order of KO_list. Hits to KOs that are not model features are dropped. KO counts of genomes found in
+        the genome cache are added to their rows.'''
+
+        genome_index = pd.Index(genome_names)
+        KO_index = pd.Index(KO_list)
+        rows, columns, counts = [], [], []
+
+        if len(diamond_out_list) > 0:
+            logging.info('Processing DIAMOND output')
+            # concatenate all results even if only one
+            results = pd.concat([pd.read_csv(os.path.join(self.diamond_out, entry), sep='\t', usecols=[0, 1],
+                                             names=['header', 'annotation']) for entry in diamond_out_list])
+
+            if len(results) < 1:
+                logging.error('No DIAMOND annotation was generated. Exiting')
+                sys.exit(1)
+
+            # headers are <genome><separator><protein>, reference names are <UniRef100 ID>~<KO>
+            genome_codes = genome_index.get_indexer(results['header'].str.partition(self.separator)[0])
+            KO_codes = KO_index.get_indexer(results['annotation'].str.partition('~')[2])
+            valid = (genome_codes >= 0) & (KO_codes >= 0)
+
+            rows.append(genome_codes[valid])
+            columns.append(KO_codes[valid])
+            counts.append(np.ones(valid.sum(), dtype=np.int32))
+
+        if cached_KO_counts is not None:
+            for genome, KO_counts in cached_KO_counts.items():
+                if genome in genome_index and len(KO_counts) > 0:
+                    KO_codes = KO_index.get_indexer(list(KO_counts.keys()))
+                    valid = KO_codes >= 0
+                    rows.append(np.full(valid.sum(), genome_index.get_loc(genome)))
+                    columns.append(KO_codes[valid])
+                    counts.append(np.array(list(KO_counts.values()), dtype=np.int32)[valid])
+
+        if len(rows) == 0:
+            return sparse.csr_matrix((len(genome_index), len(KO_index)), dtype=np.int32)
+
+        # duplicate entries are summed
+        return sparse.coo_matrix((np.concatenate(counts), (np.concatenate(rows), np.concatenate(columns))),
+                                 shape=(len(genome_index), len(KO_index)), dtype=np.int32).tocsr()
+
+    def process_diamond_output(self, KO_counts):
+        '''Return the KO feature array (KO counts followed by pathway, module and category completeness) for a
+        sparse genomes x KOs count matrix.'''
+
+        KeggCalc = keggData.KeggCalculator()
 
         #logging.info('Calculating completeness of pathways and modules.')
         logging.debug('Calculating pathway completeness information')
-        KO_pathways = KeggCalc.calculate_KO_group('KO_Pathways', KO_genes.copy())
+        KO_pathways = KeggCalc.calculate_KO_group('KO_Pathways', KO_counts)
 
         logging.debug('Calculating category completeness information')
-        KO_categories = KeggCalc.calculate_KO_group('KO_Categories', KO_genes.copy())
+        KO_categories = KeggCalc.calculate_KO_group('KO_Categories', KO_counts)
 
         logging.debug('Calculating module completeness information')
-        KO_modules = KeggCalc.calculate_module_completeness(KO_genes.copy())
+        KO_modules = KeggCalc.calculate_module_completeness(KO_counts)
 
-        diamond_complete_results = pd.concat([KO_genes, KO_pathways, KO_modules, KO_categories], axis=1)
-        return diamond_complete_results, len(defaultKOs.keys())
+        return np.hstack([KO_counts.toarray(), KO_pathways, KO_modules, KO_categories])
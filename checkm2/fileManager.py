@@ -3,14 +3,13 @@ import errno
 import sys
 import logging
 import shutil
-import requests
 import json
 import gzip
 import tempfile
+import subprocess
 
 from checkm2 import versionControl
 from checkm2.defaultValues import DefaultValues
-from checkm2 import zenodo_backpack
 
 class DiamondDB:
     def __init__(self):
@@ -107,6 +106,8 @@ class DiamondDB:
         
         make_sure_path_exists(os.path.join(download_location, 'CheckM2_database'))
         
+        # requests and tqdm are only needed for downloads
+        from checkm2 import zenodo_backpack
         backpack_downloader = zenodo_backpack.zenodo_backpack_downloader('INFO')
         highest_compatible_version, DOI = versionControl.VersionControl().return_highest_compatible_DB_version()
 
@@ -143,6 +144,90 @@ class DiamondDB:
             logging.error('Could not verify successfull installation of reference database.')
 
 
+    def prune_database(self, threads=1):
+
+        '''Builds a copy of the current database containing only reference sequences annotated with a KO that is
+        a model feature, registers its checksum and makes it the current database'''
+
+        logging.info("Command: Prune database. Checking current database.")
+
+        source_location = os.path.abspath(self.get_DB_location())
+        check_if_file_exists(source_location)
+        vc = versionControl.VersionControl()
+        if vc.return_pruned_DIAMOND_size(source_location) is not None:
+            logging.error('Database at {} is already pruned.'.format(source_location))
+            sys.exit(1)
+        if not vc.checksum_version_validate_DIAMOND(source_location):
+            logging.error('Database at {} is not compatible with this version of CheckM2.'.format(source_location))
+            sys.exit(1)
+
+        pruned_location = '{}.pruned.dmnd'.format(os.path.splitext(source_location)[0])
+        try:
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(pruned_location)):
+                pass
+        except OSError:
+            logging.error("You do not appear to have permission to write to {}.".format(os.path.dirname(pruned_location)))
+            sys.exit(1)
+
+        with open(DefaultValues.FEATURE_ORDER_LOCATION) as fo:
+            model_KOs = set(json.load(fo)['KO_Genes'])
+
+        logging.info('Extracting reference sequences annotated with one of {} model KOs.'.format(len(model_KOs)))
+
+        total_seqs, kept_seqs, total_letters = 0, 0, 0
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(pruned_location), suffix='.faa') as pruned_fasta:
+            try:
+                getseq = subprocess.Popen(['diamond', 'getseq', '--db', source_location, '--quiet'],
+                                          stdout=subprocess.PIPE, universal_newlines=True)
+            except OSError:
+                logging.error("Make sure diamond is on your system path.")
+                sys.exit(1)
+
+            # reference headers are <UniRef100 ID>~<KO>
+            keep = False
+            for line in getseq.stdout:
+                if line.startswith('>'):
+                    total_seqs += 1
+                    header = line[1:].split(None, 1)[0]
+                    keep = '~' in header and header.split('~', 1)[1] in model_KOs
+                    kept_seqs += keep
+                else:
+                    total_letters += len(line.rstrip())
+                if keep:
+                    pruned_fasta.write(line)
+            pruned_fasta.flush()
+
+            if getseq.wait() != 0 or total_seqs == 0:
+                logging.error('Could not extract sequences from DIAMOND database {}.'.format(source_location))
+                sys.exit(1)
+
+            logging.info('Keeping {} of {} reference sequences ({:.2f}%). Building pruned database.'.format(
+                kept_seqs, total_seqs, 100 * kept_seqs / total_seqs))
+
+            try:
+                subprocess.check_call(['diamond', 'makedb', '--in', pruned_fasta.name, '-d', pruned_location,
+                                       '--threads', str(threads), '--quiet'])
+            except Exception as e:
+                logging.error('An error occured while building the pruned DIAMOND database: {}'.format(e))
+                sys.exit(1)
+
+        # E-values are calculated against the size of the full database, so results stay comparable
+        vc.register_pruned_DIAMOND(pruned_location, source_location, total_letters)
+
+        diamond_definition = self.__get_db_file()
+        diamond_definition['DBPATH'] = pruned_location
+        with open(DefaultValues.DB_LOCATION_DEFINITION, 'w') as dd:
+            json.dump(diamond_definition, dd)
+
+        logging.info('Pruned database written to {} ({:.2f} GB, down from {:.2f} GB) and set as current database.'.format(
+            pruned_location, os.path.getsize(pruned_location) / 1e9, os.path.getsize(source_location) / 1e9))
+        logging.warning('Proteins whose best hit in the full database is a KO not used by the models may now be '
+                        'assigned a model KO instead, so a small number of annotations can differ. '
+                        'Use <checkm2 database --setdblocation {}> to switch back.'.format(source_location))
+        if DefaultValues.DB_VAR in os.environ:
+            logging.warning('The {} environmental variable overrides the current database. Point it to {} to use '
+                            'the pruned database.'.format(DefaultValues.DB_VAR, pruned_location))
+
     def update_database(self):
         pass
 
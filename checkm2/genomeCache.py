@@ -0,0 +1,171 @@
+from checkm2.defaultValues import DefaultValues
+from checkm2 import fileManager
+from checkm2 import version
+from checkm2.proteinCache import ProteinAnnotationCache
+
+import os
+import gzip
+import json
+import hashlib
+import logging
+import tempfile
+
+
+class GenomeCache():
+
+    ''' Content-addressed on-disk cache of per-genome results, shared between CheckM2 runs.
+
+        Genomes are keyed by the sha256 of their (decompressed) sequence file. Each genome has one record
+        per stage, and each stage record is tagged with a fingerprint of everything that produced it:
+
+            genes:       chosen translation table, genome statistics and protein metadata
+                         (CheckM2 version, requested translation table and whether it was pre-screened)
+            kos:         KO annotation counts from DIAMOND (genes + DIAMOND database and thresholds)
+            predictions: model predictions (kos + model files and whether the reference search was approximate)
+
+        Fingerprints are chained, so changing e.g. the DIAMOND database invalidates the KO counts and the
+        predictions of a genome but still reuses its translation table. The DIAMOND database and model files
+        are identified by their sha256, memoised in the protein annotation cache of the same directory.
+    '''
+
+    STAGES = ['genes', 'kos', 'predictions']
+
+    def __init__(self, cache_dir, diamond_location=None, ttable=None, approximate=False, ttable_prescreen=False):
+        self.cache_dir = os.path.abspath(cache_dir)
+        fileManager.make_sure_path_exists(self.cache_dir)
+
+        self.diamond_location = diamond_location
+        self.ttable = ttable
+        self.approximate = approximate
+        self.ttable_prescreen = ttable_prescreen
+
+        # only computed once records are read or written, so inspecting or pruning the cache hashes no files
+        self.fingerprints = None
+
+    def __set_fingerprints(self):
+        checksums = ProteinAnnotationCache(self.cache_dir)
+
+        genes = ['genes', version.__version__, self.ttable]
+        # keep fingerprints of genes called with both translation tables unchanged
+        if self.ttable_prescreen:
+            genes.append('prescreen')
+        genes = self.__fingerprint(genes)
+        kos = self.__fingerprint([genes, self.__file_identity(checksums, self.diamond_location),
+                                  DefaultValues.DIAMOND_QUERY_COVER, DefaultValues.DIAMOND_SUBJECT_COVER,
+                                  DefaultValues.DIAMOND_PERCENT_ID, DefaultValues.DIAMOND_EVALUE])
+        predictions = [kos] + [self.__file_identity(checksums, model) for model in DefaultValues.EXTERNAL_FILES_TO_VERIFY]
+        # keep fingerprints of exact predictions unchanged
+        if self.approximate:
+            predictions.append('approximate')
+        predictions = self.__fingerprint(predictions)
+
+        self.fingerprints = {'genes': genes, 'kos': kos, 'predictions': predictions}
+
+    def __fingerprint(self, components):
+        return hashlib.sha256(json.dumps(components, default=str).encode()).hexdigest()[:16]
+
+    def __file_identity(self, checksums, location):
+        if location is None or not os.path.exists(location):
+            return None
+        return checksums.file_checksum(location)
+
+    def __record_path(self, key, stage):
+        if self.fingerprints is None:
+            self.__set_fingerprints()
+        return os.path.join(self.cache_dir, key[:2], key, '{}.{}.json'.format(stage, self.fingerprints[stage]))
+
+    def genome_key(self, bin_file):
+        '''sha256 of the genome sequence; gzipped files are hashed after decompression.'''
+
+        sha256_hash = hashlib.sha256()
+        opener = gzip.open if bin_file.endswith('.gz') else open
+        with opener(bin_file, 'rb') as f:
+            for byte_block in iter(lambda: f.read(1 << 20), b""):
+                sha256_hash.update(byte_block)
+        return sha256_hash.hexdigest()
+
+    def get(self, key, stage):
+        record_path = self.__record_path(key, stage)
+        try:
+            with open(record_path) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # access time drives eviction; atime is unreliable on many filesystems, so touch the record
+        try:
+            os.utime(record_path)
+        except OSError:
+            pass
+        return record
+
+    def put(self, key, stage, record):
+        record_path = self.__record_path(key, stage)
+        fileManager.make_sure_path_exists(os.path.dirname(record_path))
+
+        # write atomically so concurrent runs never see partial records
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(record_path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(record, f, default=lambda x: x.item())
+            os.replace(tmp_path, record_path)
+        except Exception as e:
+            logging.warning('Could not write genome cache record {}: {}'.format(record_path, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def __records(self):
+        records = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            for f in files:
+                if f.endswith('.json'):
+                    path = os.path.join(root, f)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    records.append((st.st_mtime, st.st_size, path))
+        return records
+
+    def stats(self):
+        records = self.__records()
+        genomes = set(os.path.basename(os.path.dirname(path)) for _, _, path in records)
+        stage_counts = dict.fromkeys(self.STAGES, 0)
+        for _, _, path in records:
+            stage = os.path.basename(path).split('.')[0]
+            if stage in stage_counts:
+                stage_counts[stage] += 1
+
+        logging.info('Genome cache at {}'.format(self.cache_dir))
+        logging.info('    {} genomes, {} records, {:.2f} MB'.format(
+            len(genomes), len(records), sum(size for _, size, _ in records) / 1e6))
+        for stage in self.STAGES:
+            logging.info('    {} records for stage "{}"'.format(stage_counts[stage], stage))
+
+    def prune(self, max_size_gb):
+        '''Evict least recently used records until the cache is below max_size_gb.'''
+
+        max_size = max_size_gb * 1e9
+        records = sorted(self.__records())
+        total_size = sum(size for _, size, _ in records)
+
+        removed = 0
+        for _, size, path in records:
+            if total_size <= max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+            removed += 1
+
+            genome_dir = os.path.dirname(path)
+            if len(os.listdir(genome_dir)) == 0:
+                os.rmdir(genome_dir)
+
+        if removed > 0:
+            logging.info('Evicted {} records from genome cache; {:.2f} MB remaining.'.format(removed, total_size / 1e6))
+
+        return removed
+
@@ -1,8 +1,15 @@
 from checkm2 import fileManager
 from checkm2.defaultValues import DefaultValues
 
+import os
 import json
+import hashlib
+import logging
+import tempfile
+import threading
+import numpy as np
 import pandas as pd
+from scipy import sparse
 pd.options.mode.chained_assignment = None  # default='warn'
 
 
@@ -11,22 +18,133 @@ class KeggCalculator:
     ''' Dependent on JSON-defined gene, pathway, category and module information
 
         Feature_order: Dictionary with ordered keys (categories) containing ordered values (feature columns)
-        Path_category_mapping: pd Dataframe with Kegg_ID, Pathway, Category as columns
-        module_definitions: Dictionary with module names as keys and corresponding KO's as values
+        Path_category_mapping: KO -> pathway and KO -> category assignments
+        module_definitions: module names and their KO's
 
         Features are ordered as follows:
        (['Metadata', 'KO_Genes', 'KO_Pathways', 'KO_Modules', 'KO_Categories'])
+
+        The JSON definitions are compiled into a feature schema: the feature order of every category and sparse
+        KO -> group membership matrices with their group sizes. The schema is loaded once per process and shared
+        by all KeggCalculators. checkm2 models --compile stores it next to the definitions together with their
+        checksum; without a stored schema that matches the definitions, it is compiled in memory on every run.
     '''
+
+    CATEGORIES = ['Metadata', 'KO_Genes', 'KO_Pathways', 'KO_Modules', 'KO_Categories']
+    GROUPS = ['KO_Pathways', 'KO_Modules', 'KO_Categories']
+
+    __schema = None
+    __schema_lock = threading.Lock()
+
     def __init__(self):
 
+        with KeggCalculator.__schema_lock:
+            if KeggCalculator.__schema is None:
+                KeggCalculator.__schema = self.__load_schema()
+
+        self.feature_order, self.feature_index, self.memberships, self.group_sizes = KeggCalculator.__schema
+
+    def __definitions_checksum(self):
+        sha256_hash = hashlib.sha256()
+        for location in [DefaultValues.FEATURE_ORDER_LOCATION, DefaultValues.PATH_CATEGORY_MAPPING_LOCATION,
+                         DefaultValues.MODULE_DEFINITION_LOCATION]:
+            with open(location, 'rb') as f:
+                sha256_hash.update(f.read())
+        return sha256_hash.hexdigest()
+
+    def __load_schema(self):
+        checksum = self.__definitions_checksum()
+
+        try:
+            with np.load(DefaultValues.FEATURE_SCHEMA_LOCATION, allow_pickle=False) as schema:
+                if str(schema['checksum']) == checksum:
+                    return self.__unpack_schema(schema)
+            logging.debug('Feature schema does not match the feature definitions. Compiling it.')
+        except (OSError, ValueError, KeyError) as e:
+            logging.debug('Could not load feature schema ({}). Compiling it.'.format(e))
+
+        return self.__unpack_schema(self.__compile_schema(checksum))
+
+    def save_schema(self):
+        '''Compile the feature schema and store it at FEATURE_SCHEMA_LOCATION. Raises OSError if it can't be
+        written.'''
+
+        schema = self.__compile_schema(self.__definitions_checksum())
+
+        # written atomically, so concurrent runs never see a partial schema
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(DefaultValues.FEATURE_SCHEMA_LOCATION), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **schema)
+            # the schema is shared by all users of an installation
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, DefaultValues.FEATURE_SCHEMA_LOCATION)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def __compile_schema(self, checksum):
+
         with open(DefaultValues.FEATURE_ORDER_LOCATION, 'r') as fo:
-            self.feature_order = json.load(fo)
+            feature_order = json.load(fo)
 
         with open(DefaultValues.PATH_CATEGORY_MAPPING_LOCATION, 'r') as pcm:
-            self.path_category_mapping = pd.DataFrame(json.load(pcm))
+            path_category_mapping = pd.DataFrame(json.load(pcm))
 
         with open(DefaultValues.MODULE_DEFINITION_LOCATION, 'r') as md:
-            self.module_definitions = json.load(md)
+            module_definitions = json.load(md)
+
+        schema = {'checksum': np.array(checksum)}
+        for category in self.CATEGORIES:
+            schema['order_{}'.format(category)] = np.array(feature_order[category], dtype=str)
+
+        ''' Entries of the membership matrices count how often a KO is listed for a group; group sizes are the number
+            of KOs listed for each group, including KOs that are not model features.
+        '''
+        KO_index = pd.Index(feature_order['KO_Genes'])
+        codes = {}
+        for group in ['KO_Pathways', 'KO_Categories']:
+            codes[group] = (KO_index.get_indexer(path_category_mapping['Kegg_ID']),
+                            pd.Index(feature_order[group]).get_indexer(path_category_mapping[group]))
+
+        modules = feature_order['KO_Modules']
+        codes['KO_Modules'] = (KO_index.get_indexer([KO for m in modules for KO in module_definitions[m]]),
+                               np.repeat(np.arange(len(modules)), [len(module_definitions[m]) for m in modules]))
+
+        for group in self.GROUPS:
+            KO_codes, group_codes = codes[group]
+            listed = group_codes >= 0
+            present = listed & (KO_codes >= 0)
+            membership = sparse.coo_matrix((np.ones(present.sum(), dtype=np.int64),
+                                            (KO_codes[present], group_codes[present])),
+                                           shape=(len(KO_index), len(feature_order[group]))).tocsr()
+
+            schema['sizes_{}'.format(group)] = np.bincount(group_codes[listed], minlength=len(feature_order[group]))
+            schema['data_{}'.format(group)] = membership.data
+            schema['indices_{}'.format(group)] = membership.indices
+            schema['indptr_{}'.format(group)] = membership.indptr
+
+        return schema
+
+    def __unpack_schema(self, schema):
+        feature_order = dict((category, schema['order_{}'.format(category)].tolist()) for category in self.CATEGORIES)
+        feature_index = dict((category, pd.Index(feature_order[category])) for category in self.CATEGORIES)
+
+        memberships, group_sizes = {}, {}
+        for group in self.GROUPS:
+            memberships[group] = sparse.csr_matrix((schema['data_{}'.format(group)],
+                                                    schema['indices_{}'.format(group)],
+                                                    schema['indptr_{}'.format(group)]),
+                                                   shape=(len(feature_order['KO_Genes']), len(feature_order[group])))
+            group_sizes[group] = schema['sizes_{}'.format(group)]
+
+        return feature_order, feature_index, memberships, group_sizes
+
+    def __normalise(self, group_totals, group):
+        # groups without any listed KOs are NaN, as 0/0 always was
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.asarray(group_totals.todense()) / self.group_sizes[group]
 
 
     def return_default_values_from_category(self, ID):
@@ -35,45 +153,22 @@ class KeggCalculator:
     def return_proper_order(self, category):
         return self.feature_order[category]
 
-    def calculate_KO_group(self, group, KO_gene_data):
-
-        #only interested in presence/absence; also exclude names (last column)
-        presence_absence_subset = KO_gene_data.iloc[:, :-1].copy()
-        presence_absence_subset[presence_absence_subset > 1] = 1
-
-        #get ordered sequence for each feature vector in group
-        ordered_entries = self.return_default_values_from_category(group)
-        feature_vectors = list(ordered_entries.keys())
-
-        for vector in feature_vectors:
-
-            #Go through category, determine total Kegg_IDs belonging to it
-            length = len(self.path_category_mapping[self.path_category_mapping[group] == vector]['Kegg_ID'])
-
-            #Count how many are present
-            KO_gene_data[vector] = (presence_absence_subset[self.path_category_mapping[self.path_category_mapping[group] == vector]['Kegg_ID'].values].sum(axis=1)) / length
-
-        #return only that part of dataframe we're interested in
-        return KO_gene_data.iloc[:, -len(feature_vectors):]
-
-    '''Module calculations differ from others as one gene can be part of multiple modules'''
-
-
-    def calculate_module_completeness(self, KO_gene_data):
-        presence_absence_subset = KO_gene_data.iloc[:, :-1].copy()
-        presence_absence_subset[presence_absence_subset > 1] = 1
-
-        modules = list(self.module_definitions.keys())
-
-        for module in modules:
-            length = len(self.module_definitions[module])
+    def return_feature_index(self, category):
+        return self.feature_index[category]
 
-            #make sure all components of the module definition are accounted for
-            self.module_definitions[module] = [x for x in self.module_definitions[module] if x in KO_gene_data.columns]
+    def calculate_KO_group(self, group, KO_counts):
+        '''Fraction of the KOs of each pathway or category present in each genome, for a sparse genomes x KOs
+        count matrix.'''
 
-            KO_gene_data[module] = (KO_gene_data[self.module_definitions[module]].sum(axis=1)) / length
+        #only interested in presence/absence
+        presence_absence = KO_counts.copy()
+        presence_absence.data = np.minimum(presence_absence.data, 1)
 
-        return KO_gene_data.iloc[:, -len(modules):]
+        return self.__normalise(presence_absence @ self.memberships[group], group)
 
+    '''Module calculations differ from others as one gene can be part of multiple modules, and KO counts
+       rather than presence/absence are summed'''
 
 
+    def calculate_module_completeness(self, KO_counts):
+        return self.__normalise(KO_counts @ self.memberships['KO_Modules'], 'KO_Modules')
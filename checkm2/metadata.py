@@ -5,10 +5,16 @@ import os
 
 class MetadataCalculator:
 
+    amino_acids = ['A', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'K', 'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'V', 'W', 'Y']
+
     def __init__(self, protein_file):
         self.protein_file = protein_file
         self.basename = os.path.splitext(os.path.basename(self.protein_file))[0]
-        self.parsed_faa = sequenceClasses.SeqReader().read_nucleotide_sequences(self.protein_file)
+        # length and amino acid counts of each protein, without building sequence strings
+        self.parsed_faa = {}
+        for name, length, counts in sequenceClasses.SeqFileReader(self.protein_file).compositions(
+                ''.join(self.amino_acids)):
+            self.parsed_faa[name] = (length, counts)
 #            self.parsed_genomes = [sequenceClasses.SeqReader().read_nucleotide_sequences(faa) for faa in
 #                                   self.protein_files]
 
@@ -16,10 +22,11 @@ class MetadataCalculator:
         return self.basename, len(self.parsed_faa.keys())
 
     def calculate_amino_acid_length(self):
-        return self.basename, np.array([len(v) for v in self.parsed_faa.values()]).sum()
+        return self.basename, np.array([length for length, _ in self.parsed_faa.values()]).sum()
 
     def calculate_amino_acid_counts(self):
-        amino_acids = ['A', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'K', 'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'V', 'W', 'Y']
-        full_aa_sequence = ''.join(value.strip() for key, value in sorted(self.parsed_faa.items()))
-        aa_counts = [full_aa_sequence.count(aa) for aa in amino_acids]
-        return self.basename, amino_acids, aa_counts
+        amino_acids = self.amino_acids
+        aa_counts = np.zeros(len(amino_acids), dtype=np.int64)
+        for _, counts in self.parsed_faa.values():
+            aa_counts += counts
+        return self.basename, amino_acids, [int(count) for count in aa_counts]
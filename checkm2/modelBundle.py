@@ -0,0 +1,213 @@
+from checkm2.defaultValues import DefaultValues
+from checkm2 import numpyNetwork
+from checkm2 import version
+
+import os
+import json
+import struct
+import hashlib
+import logging
+import tempfile
+import threading
+import numpy as np
+
+
+class BundledScaler():
+
+    ''' Min-max scaling with the parameters of the scaler saved in SCALER_FILE_LOCATION, applied in the same way as
+        sklearn's MinMaxScaler.transform so results are identical.
+    '''
+
+    def __init__(self, scale, minimum, clip=False, feature_range=(0, 1)):
+        self.scale_ = scale
+        self.min_ = minimum
+        self.clip = clip
+        self.feature_range = feature_range
+
+    def transform(self, X):
+        X = np.array(X, dtype=np.float64)
+        X *= self.scale_
+        X += self.min_
+        if self.clip:
+            np.clip(X, self.feature_range[0], self.feature_range[1], out=X)
+        return X
+
+
+class ModelBundle():
+
+    ''' All models and reference data needed for predictions, packed into one memory-mapped file.
+
+        The bundle is compiled once (checkm2 models --compile) into MODEL_BUNDLE_LOCATION. It holds the scaler
+        parameters, the text of both LightGBM boosters, the weights of the exported specific network and the
+        normalised reference index with its clusters. Arrays are stored uncompressed and aligned, so loading them
+        only maps the file: concurrent CheckM2 processes share the same pages, and no model file is parsed apart
+        from the boosters.
+
+        The file starts with a JSON header recording the bundle format, the CheckM2 version, the size and
+        modification time of every source file, and the sha256 checksum of the arrays. A bundle that doesn't
+        match the format, the CheckM2 version or its source files is ignored, and the original files are used.
+        The checksum is only verified by checkm2 models --check, as verifying it means reading the whole file.
+    '''
+
+    MAGIC = b'CHECKM2 MODEL BUNDLE\n'
+    FORMAT_VERSION = 1
+    # arrays start at multiples of this, so they can be viewed in place with any dtype
+    ALIGNMENT = 64
+
+    __instance = None
+    __loaded = False
+    __lock = threading.Lock()
+
+    @classmethod
+    def load(cls, location=None):
+        '''The bundle at MODEL_BUNDLE_LOCATION, loaded once per process, or None if there is none or it is out of
+        date.'''
+
+        with cls.__lock:
+            if not cls.__loaded:
+                cls.__instance = cls.open(location)
+                cls.__loaded = True
+        return cls.__instance
+
+    @classmethod
+    def open(cls, location=None):
+        location = DefaultValues.MODEL_BUNDLE_LOCATION if location is None else location
+        if not os.path.exists(location):
+            return None
+
+        try:
+            bundle = cls(location)
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            logging.warning('Model bundle {} could not be read ({}); using the original model files instead. Run '
+                            '"checkm2 models --compile" to compile it again.'.format(location, e))
+            return None
+
+        reason = bundle.mismatch()
+        if reason is not None:
+            logging.warning('Model bundle {} is out of date ({}); using the original model files instead. Run '
+                            '"checkm2 models --compile" to compile it again.'.format(location, reason))
+            return None
+
+        return bundle
+
+    @staticmethod
+    def sources():
+        '''Path, size and modification time of every file a bundle is compiled from, or None for missing files.'''
+
+        locations = {'general_model': DefaultValues.GENERAL_MODEL_COMP_LOCATION,
+                     'contamination_model': DefaultValues.MODEL_CONT_LOCATION,
+                     'scaler': DefaultValues.SCALER_FILE_LOCATION,
+                     'specific_model': DefaultValues.SPECIFIC_MODEL_COMP_LOCATION,
+                     'specific_model_numpy': DefaultValues.SPECIFIC_MODEL_NUMPY_LOCATION,
+                     'reference_data': DefaultValues.REF_DATA_LOCATION}
+
+        identities = {}
+        for name, location in locations.items():
+            try:
+                st = os.stat(location)
+                identities[name] = [os.path.abspath(location), st.st_size, st.st_mtime_ns]
+            except OSError:
+                identities[name] = None
+        return identities
+
+    @classmethod
+    def write(cls, arrays, metadata, location=None):
+        '''Write a dict of arrays with a dict of JSON metadata into a bundle.'''
+
+        location = DefaultValues.MODEL_BUNDLE_LOCATION if location is None else location
+        arrays = dict((name, np.ascontiguousarray(array)) for name, array in arrays.items())
+
+        specs, offset = {}, 0
+        sha256_hash = hashlib.sha256()
+        for name, array in arrays.items():
+            padding = -offset % cls.ALIGNMENT
+            sha256_hash.update(bytes(padding))
+            offset += padding
+            specs[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            sha256_hash.update(memoryview(array).cast('B'))
+            offset += array.nbytes
+
+        header = json.dumps({'format': cls.FORMAT_VERSION, 'checkm2_version': version.__version__,
+                             'sources': cls.sources(), 'sha256': sha256_hash.hexdigest(), 'arrays': specs,
+                             'metadata': metadata}).encode()
+        header += b' ' * (-(len(cls.MAGIC) + 8 + len(header)) % cls.ALIGNMENT)
+
+        # write atomically, so concurrent runs never load a partial bundle
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(location)), suffix='.bundle')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(cls.MAGIC)
+                f.write(struct.pack('<Q', len(header)))
+                f.write(header)
+                written = 0
+                for name, array in arrays.items():
+                    f.write(bytes(specs[name]['offset'] - written))
+                    f.write(memoryview(array).cast('B'))
+                    written = specs[name]['offset'] + array.nbytes
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, location)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def __init__(self, location):
+        self.location = location
+
+        with open(location, 'rb') as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError('not a model bundle')
+            header_length = struct.unpack('<Q', f.read(8))[0]
+            self.header = json.loads(f.read(header_length).decode())
+
+        self.metadata = self.header['metadata']
+        self.__data_start = len(self.MAGIC) + 8 + header_length
+
+        self.arrays = {}
+        if len(self.header['arrays']) > 0:
+            self.__map = np.memmap(location, dtype=np.uint8, mode='r')
+            for name, spec in self.header['arrays'].items():
+                dtype = np.dtype(spec['dtype'])
+                start = self.__data_start + spec['offset']
+                end = start + dtype.itemsize * int(np.prod(spec['shape']))
+                self.arrays[name] = self.__map[start:end].view(dtype).reshape(spec['shape'])
+
+    def mismatch(self):
+        '''Why the bundle can't be used with the installed files, or None if it can.'''
+
+        if self.header['format'] != self.FORMAT_VERSION:
+            return 'bundle format {} instead of {}'.format(self.header['format'], self.FORMAT_VERSION)
+        if self.header['checkm2_version'] != version.__version__:
+            return 'compiled by CheckM2 version {}'.format(self.header['checkm2_version'])
+        sources = self.sources()
+        for name, identity in self.header['sources'].items():
+            if sources.get(name) != identity:
+                return '{} has changed'.format(name)
+        return None
+
+    def verify(self):
+        '''Check the arrays against the checksum they were written with.'''
+
+        sha256_hash = hashlib.sha256()
+        with open(self.location, 'rb') as f:
+            f.seek(self.__data_start)
+            for byte_block in iter(lambda: f.read(1 << 20), b""):
+                sha256_hash.update(byte_block)
+        return sha256_hash.hexdigest() == self.header['sha256']
+
+    def scaler(self):
+        settings = self.metadata['scaler']
+        return BundledScaler(self.arrays['scaler_scale'], self.arrays['scaler_min'], settings['clip'],
+                             tuple(settings['feature_range']))
+
+    def booster_strings(self):
+        return [self.arrays['booster_{}'.format(i)].tobytes().decode() for i in range(self.metadata['boosters'])]
+
+    def network(self, float32=False):
+        settings = self.metadata['network']
+        weights = [[self.arrays['network_{}_{}'.format(i, j)] for j in range(count)]
+                   for i, count in enumerate(settings['weight_counts'])]
+        return numpyNetwork.NumpyNetwork(settings['layers'], weights, settings['input_shape'], float32)
+
+    def reference_arrays(self):
+        return [self.arrays['reference_{}'.format(name)] for name in ['data', 'indices', 'indptr']], \
+               self.arrays['reference_clusters']
@@ -0,0 +1,257 @@
+from checkm2.defaultValues import DefaultValues
+from checkm2 import numpyNetwork
+from checkm2 import treeEnsemble
+from checkm2 import modelBundle
+from checkm2 import modelPostprocessing
+from checkm2 import keggData
+
+import os
+import sys
+import time
+import pickle
+import logging
+import numpy as np
+from scipy.sparse import csr_matrix
+
+#make sure we're only using CPUs as GPUs can throw weird errors and is not worth the minor speed advantage
+os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+
+class ModelCompiler():
+
+    ''' Converts the models shipped with CheckM2 into formats that are faster to load and run, and checks the
+        converted models against the originals.
+    '''
+
+    def __init__(self, samples=DefaultValues.MODEL_CHECK_SAMPLES, threads=1):
+        self.samples = samples
+        self.threads = threads
+
+    def __load_keras_model(self):
+        try:
+            from tensorflow import keras
+        except ImportError:
+            logging.error('TensorFlow is required to export or check the specific model.')
+            sys.exit(1)
+        try:
+            return keras.models.load_model(DefaultValues.SPECIFIC_MODEL_COMP_LOCATION)
+        except Exception as e:
+            logging.error("Saved models could not be loaded: {}".format(e))
+            sys.exit(1)
+
+    def __load_network(self):
+        # the exported network if there is one, as it doesn't need TensorFlow
+        network = numpyNetwork.NumpyNetwork.load(float32=DefaultValues.NUMPY_NETWORK_FLOAT32)
+        if network is not None:
+            return network
+        try:
+            return numpyNetwork.NumpyNetwork.from_keras(self.__load_keras_model(), DefaultValues.NUMPY_NETWORK_FLOAT32)
+        except ValueError as e:
+            logging.error('The specific model could not be converted: {}'.format(e))
+            sys.exit(1)
+
+    def __load_scaler(self):
+        try:
+            return pickle.load(open(DefaultValues.SCALER_FILE_LOCATION, 'rb'))
+        except Exception as e:
+            logging.error("Saved models could not be loaded: {}".format(e))
+            sys.exit(1)
+
+    def __test_vectors(self, width, samples=None):
+        # feature vectors are mostly zero, as most KOs are absent from a genome
+        samples = self.samples if samples is None else samples
+        rng = np.random.RandomState(0)
+        vectors = rng.rand(samples, width)
+        vectors[rng.rand(samples, width) > 0.1] = 0
+        return vectors
+
+    def export_network(self):
+        '''Export the specific model for NumPy inference, then check it against Keras.'''
+
+        model = self.__load_keras_model()
+        try:
+            network = numpyNetwork.NumpyNetwork.from_keras(model)
+        except ValueError as e:
+            logging.error('The specific model could not be exported: {}'.format(e))
+            sys.exit(1)
+
+        network.save(DefaultValues.SPECIFIC_MODEL_NUMPY_LOCATION,
+                     numpyNetwork.NumpyNetwork.source_checksum(DefaultValues.SPECIFIC_MODEL_COMP_LOCATION))
+        logging.info('Exported specific model to {}.'.format(DefaultValues.SPECIFIC_MODEL_NUMPY_LOCATION))
+
+        try:
+            self.check_network(model)
+        except SystemExit:
+            # only exports that match Keras are kept, as they are used for predictions and compiled into bundles
+            os.remove(DefaultValues.SPECIFIC_MODEL_NUMPY_LOCATION)
+            logging.error('Removed {}.'.format(DefaultValues.SPECIFIC_MODEL_NUMPY_LOCATION))
+            raise
+
+    def compile_bundle(self):
+        '''Store the feature schema and the reference index, and pack the scaler, the general models, the specific
+        network and the reference index into one bundle, then check the bundle against the original files.
+
+        The specific network is taken from its export, which has been checked against Keras by checkm2 models --export.'''
+
+        network = numpyNetwork.NumpyNetwork.load(float32=DefaultValues.NUMPY_NETWORK_FLOAT32)
+        if network is None:
+            logging.error('No exported specific model found. Run <checkm2 models --export> before compiling.')
+            sys.exit(1)
+        scaler = self.__load_scaler()
+        # builds the reference index from the reference data if there isn't a stored one yet
+        references = modelPostprocessing.ReferenceIndex.load()
+
+        try:
+            keggData.KeggCalculator().save_schema()
+            references.save()
+        except OSError as e:
+            logging.error('Feature schema or reference index could not be written: {}'.format(e))
+            sys.exit(1)
+        logging.info('Stored feature schema in {} and reference index in {}.'.format(
+            DefaultValues.FEATURE_SCHEMA_LOCATION, DefaultValues.REF_INDEX_LOCATION))
+
+        arrays = {'scaler_scale': np.asarray(scaler.scale_, dtype=np.float64),
+                  'scaler_min': np.asarray(scaler.min_, dtype=np.float64)}
+        model_locations = [DefaultValues.GENERAL_MODEL_COMP_LOCATION, DefaultValues.MODEL_CONT_LOCATION]
+        for i, location in enumerate(model_locations):
+            with open(location, 'rb') as f:
+                arrays['booster_{}'.format(i)] = np.frombuffer(f.read(), dtype=np.uint8)
+        for i, layer_weights in enumerate(network.weights):
+            for j, weights in enumerate(layer_weights):
+                arrays['network_{}_{}'.format(i, j)] = weights
+        for name in modelPostprocessing.ReferenceIndex.ARRAYS:
+            arrays['reference_{}'.format(name)] = getattr(references.references, name)
+        arrays['reference_clusters'] = references.cluster_assignment()
+
+        metadata = {'scaler': {'clip': bool(getattr(scaler, 'clip', False)),
+                               'feature_range': list(scaler.feature_range)},
+                    'boosters': len(model_locations),
+                    'network': {'layers': network.layers, 'weight_counts': [len(w) for w in network.weights],
+                                'input_shape': list(network.input_shape)}}
+
+        try:
+            modelBundle.ModelBundle.write(arrays, metadata)
+        except OSError as e:
+            logging.error('Model bundle could not be written: {}'.format(e))
+            sys.exit(1)
+        logging.info('Compiled models into {} ({:.1f} MB).'.format(
+            DefaultValues.MODEL_BUNDLE_LOCATION, os.path.getsize(DefaultValues.MODEL_BUNDLE_LOCATION) / 1e6))
+
+        self.check_bundle(network)
+
+    def check_bundle(self, network=None):
+        '''Verify the bundle checksum, and compare the bundled models with the original files on random feature
+        vectors. Bundled models are copies of the originals, so predictions have to be identical.'''
+
+        bundle = modelBundle.ModelBundle.open()
+        if bundle is None:
+            logging.error('No usable model bundle found. Run <checkm2 models --compile> first.')
+            sys.exit(1)
+        if not bundle.verify():
+            logging.error('Model bundle {} does not match its checksum. Run <checkm2 models --compile> to compile '
+                          'it again.'.format(bundle.location))
+            sys.exit(1)
+
+        if network is None:
+            network = self.__load_network()
+        ensemble = treeEnsemble.TreeEnsemble([DefaultValues.GENERAL_MODEL_COMP_LOCATION,
+                                              DefaultValues.MODEL_CONT_LOCATION])
+        vectors = self.__test_vectors(ensemble.feature_count)
+
+        scaled = self.__load_scaler().transform(vectors)
+        width = int(np.prod(network.input_shape))
+        bundled_ensemble = treeEnsemble.TreeEnsemble(model_strings=bundle.booster_strings())
+        comparisons = [('scaler', scaled, bundle.scaler().transform(vectors)),
+                       ('general models', ensemble.predict(vectors, self.threads),
+                        bundled_ensemble.predict(vectors, self.threads)),
+                       ('specific model', network.predict(scaled[:, :width]),
+                        bundle.network(DefaultValues.NUMPY_NETWORK_FLOAT32).predict(scaled[:, :width]))]
+
+        passed = True
+        for name, original, bundled in comparisons:
+            if not np.array_equal(original, bundled):
+                logging.error('Bundled {} predictions differ from the original files.'.format(name))
+                passed = False
+
+        if not passed:
+            logging.error('Remove {} to use the original model files instead.'.format(
+                DefaultValues.MODEL_BUNDLE_LOCATION))
+            sys.exit(1)
+        logging.info('Model bundle matches its checksum and the original model files.')
+
+    def check(self):
+        '''Check every converted model that is present.'''
+
+        if not os.path.exists(DefaultValues.SPECIFIC_MODEL_NUMPY_LOCATION) and \
+                not os.path.exists(DefaultValues.MODEL_BUNDLE_LOCATION):
+            logging.error('No converted models found. Run <checkm2 models --export> or <checkm2 models --compile> '
+                          'first.')
+            sys.exit(1)
+        if os.path.exists(DefaultValues.SPECIFIC_MODEL_NUMPY_LOCATION):
+            self.check_network()
+        if os.path.exists(DefaultValues.MODEL_BUNDLE_LOCATION):
+            self.check_bundle()
+
+    def check_network(self, model=None):
+        '''Compare NumPy and Keras predictions of the specific model on random feature vectors.'''
+
+        if numpyNetwork.NumpyNetwork.load() is None:
+            logging.error('No exported specific model found. Run <checkm2 models --export> first.')
+            sys.exit(1)
+        if model is None:
+            model = self.__load_keras_model()
+
+        vectors = self.__test_vectors(int(np.prod(model.input_shape[1:])))
+
+        start = time.time()
+        keras_predictions = model.predict(vectors.reshape((len(vectors),) + tuple(model.input_shape[1:]))) * 100
+        logging.info('Keras: {} genomes in {:.2f} s.'.format(len(vectors), time.time() - start))
+
+        passed = True
+        for float32 in [False, True]:
+            network = numpyNetwork.NumpyNetwork.load(float32=float32)
+            network_input = csr_matrix(vectors) if network.sparse_input else vectors
+
+            start = time.time()
+            predictions = network.predict(network_input) * 100
+            elapsed = time.time() - start
+
+            difference = np.max(np.abs(predictions - keras_predictions))
+            # only the precision used for predictions has to match
+            if float32 == DefaultValues.NUMPY_NETWORK_FLOAT32:
+                passed = difference <= DefaultValues.NUMPY_NETWORK_TOLERANCE
+            logging.info('NumPy ({}): {} genomes in {:.2f} s, largest difference to Keras {:.2e} completeness '
+                         'points.'.format('float32' if float32 else 'float64', len(vectors), elapsed, difference))
+
+        if not passed:
+            logging.error('NumPy predictions differ from Keras by more than {} completeness points. Remove {} to use '
+                          'Keras instead.'.format(DefaultValues.NUMPY_NETWORK_TOLERANCE,
+                                                  DefaultValues.SPECIFIC_MODEL_NUMPY_LOCATION))
+            sys.exit(1)
+        logging.info('Exported specific model matches Keras.')
+
+    def benchmark(self, genomes=DefaultValues.MODEL_BENCHMARK_GENOMES):
+        '''Compare throughput of the general models predicted together from sparse features with predicting each
+        of them from dense feature vectors.'''
+
+        ensemble = treeEnsemble.TreeEnsemble([DefaultValues.GENERAL_MODEL_COMP_LOCATION,
+                                              DefaultValues.MODEL_CONT_LOCATION])
+
+        vectors = self.__test_vectors(ensemble.feature_count, genomes)
+        logging.info('Predicting completeness and contamination of {} random genomes with {} threads.'.format(
+            genomes, self.threads))
+
+        start = time.time()
+        dense_predictions = np.column_stack([booster.predict(vectors, n_jobs=self.threads)
+                                             for booster in ensemble.boosters])
+        dense_time = time.time() - start
+
+        start = time.time()
+        predictions = ensemble.predict(vectors, self.threads)
+        sparse_time = time.time() - start
+
+        for name, elapsed in [('Dense', dense_time), ('Sparse', sparse_time)]:
+            logging.info('{}: {:.2f} s per 10k genomes ({:.0f} genomes/s).'.format(
+                name, elapsed * 1e4 / genomes, genomes / elapsed))
+        logging.info('Speedup {:.1f}x, largest difference {:.2e}.'.format(
+            dense_time / sparse_time, np.max(np.abs(predictions - dense_predictions))))
@@ -1,4 +1,5 @@
 from checkm2.defaultValues import DefaultValues
+from checkm2 import modelBundle
 import scipy
 from scipy import sparse
 from scipy.sparse import csr_matrix
@@ -6,96 +7,287 @@ import numpy as np
 import logging
 import sys
 import os
+import json
 import pickle
+import shutil
+import tempfile
+import threading
 import pandas as pd
 
 
-class modelProcessor:
+class ReferenceIndex:
 
-    def __init__(self, threads=1):
-        # self.logger = logging.getLogger('timestamp')
+    ''' Reference genomes for the cosine similarity step, restricted to metadata and KO count features, with rows
+        normalised to unit length and stored as float32 CSR arrays.
+
+        The index is loaded once per process, so all modelProcessors share it. checkm2 models --compile stores it
+        in REF_INDEX_LOCATION, from where it is memory-mapped so worker processes share the same read-only pages,
+        as long as the reference data is unchanged (by size and modification time). If a model bundle has been
+        compiled, the index is mapped from the bundle instead. Otherwise it is built from REF_DATA_LOCATION in
+        memory on every run.
+
+        For the approximate search, references are additionally grouped into about sqrt(n) clusters with spherical
+        k-means. A query is only compared exactly to the references in the REF_ANN_PROBES clusters whose centroids
+        are closest to it, so its similarity can be underestimated but never overestimated.
+    '''
+
+    # metadata and KO count features; pathway, module and category completeness are not compared
+    FEATURE_COUNT = 20021
+    ARRAYS = ['data', 'indices', 'indptr']
+
+    __instance = None
+    __lock = threading.Lock()
+
+    @classmethod
+    def load(cls):
+        with cls.__lock:
+            if cls.__instance is None:
+                cls.__instance = cls()
+        return cls.__instance
+
+    def __init__(self):
+        self.__assignment = None
+        # clusters stored in REF_INDEX_LOCATION are only valid for references loaded from there
+        self.__stored = False
+        bundle = modelBundle.ModelBundle.load()
+
+        if bundle is not None:
+            arrays, self.__assignment = bundle.reference_arrays()
+        else:
+            source = self.__source_identity()
+            try:
+                with open(os.path.join(DefaultValues.REF_INDEX_LOCATION, 'source.json')) as f:
+                    if json.load(f) != source:
+                        raise ValueError('reference data has changed')
+                arrays = [np.load(os.path.join(DefaultValues.REF_INDEX_LOCATION, '{}.npy'.format(name)),
+                                  mmap_mode='r') for name in self.ARRAYS]
+                self.__stored = True
+            except (OSError, ValueError) as e:
+                logging.debug('Building reference index: {}'.format(e))
+                arrays = self.__build()
+
+        self.references = csr_matrix(tuple(arrays), shape=(len(arrays[2]) - 1, self.FEATURE_COUNT), copy=False)
+
+        # built on first use of the approximate search
+        self.clusters = None
+
+    def __source_identity(self):
+        try:
+            st = os.stat(DefaultValues.REF_DATA_LOCATION)
+        except OSError as e:
+            logging.error("Error: Reference data could not be loaded: {}".format(e))
+            sys.exit(1)
+        return [os.path.abspath(DefaultValues.REF_DATA_LOCATION), st.st_size, st.st_mtime_ns]
 
+    def __build(self):
         try:
-            self.ref_data = scipy.sparse.load_npz(DefaultValues.REF_DATA_LOCATION)
+            ref_data = scipy.sparse.load_npz(DefaultValues.REF_DATA_LOCATION)
         except Exception as e:
             logging.error("Error: Reference data could not be loaded: {}".format(e))
             sys.exit(1)
 
-        self.threads = threads
-        self.reduced_cutoff = DefaultValues.AA_RATIO_COMPLETENESS_CUTOFF
+        references = csr_matrix(ref_data[:, :self.FEATURE_COUNT], dtype=np.float64)
+        norms = np.sqrt(np.asarray(references.multiply(references).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        references = csr_matrix(sparse.diags(1 / norms) @ references, dtype=np.float32)
+        references.sort_indices()
 
-        # Returns cosine similarity matrix
+        return [references.data, references.indices, references.indptr]
 
-    def __calculate_sparse_CSM(self, A, B):
+    def save(self):
+        '''Store the index and its clusters in REF_INDEX_LOCATION. Raises OSError if it can't be written.'''
 
-        # Reshape is require to deal with scipy's deviation from numpy calculations
-        num = np.dot(A, B.T)
+        # written to a temporary directory first, so concurrent runs never see a partial index
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(DefaultValues.REF_INDEX_LOCATION), prefix='.reference_index')
+        try:
+            for name in self.ARRAYS:
+                np.save(os.path.join(tmp_dir, '{}.npy'.format(name)), getattr(self.references, name))
+            np.save(os.path.join(tmp_dir, 'clusters.npy'), self.cluster_assignment())
+            with open(os.path.join(tmp_dir, 'source.json'), 'w') as f:
+                json.dump(self.__source_identity(), f)
+            os.chmod(tmp_dir, 0o755)
+            if os.path.exists(DefaultValues.REF_INDEX_LOCATION):
+                shutil.rmtree(DefaultValues.REF_INDEX_LOCATION, ignore_errors=True)
+            os.replace(tmp_dir, DefaultValues.REF_INDEX_LOCATION)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
 
-        p1 = np.sqrt(np.sum(A.power(2), axis=1))[:, np.newaxis]
-        p1 = p1.reshape(p1.shape[0], p1.shape[1])
+    def max_similarity(self, feature_vectors):
+        '''Cosine similarity of each feature vector to its closest reference genome.
 
-        p2 = np.sqrt(np.sum(B.power(2), axis=1))[np.newaxis, :]
-        p2 = p2.reshape(p2.shape[0], p2.shape[1])
+        Queries are processed in blocks so that memory stays bounded by REF_QUERY_BLOCK_MB however many are passed.
+        As the references are normalised, the best match of a query is found before dividing by its own norm.
+        '''
 
-        return np.array(num / (p1 * p2))
+        queries = csr_matrix(feature_vectors)[:, :self.FEATURE_COUNT]
+        query_norms = np.sqrt(np.asarray(queries.multiply(queries).sum(axis=1)).ravel())
 
-    def __calculate_cosine_similarity(self, feature_vector):
-        # Todo - if input is big, we might need to chunk it so as not to overload RAM (depends on ref data size). 
+        block_size = max(1, int(DefaultValues.REF_QUERY_BLOCK_MB * 1e6 //
+                                (8 * (self.references.shape[0] + self.FEATURE_COUNT))))
+
+        best = np.empty(queries.shape[0])
+        for start in range(0, queries.shape[0], block_size):
+            block = queries[start:start + block_size].toarray().T
+            best[start:start + block_size] = np.amax(self.references @ block, axis=0)
+
+        # queries without any features are NaN, as before
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return best / query_norms
+
+    def __cluster(self, references):
+        '''Spherical k-means cluster of every reference row, with a fixed seed so that indexes are reproducible.'''
+
+        rng = np.random.RandomState(0)
+        cluster_count = max(1, int(np.sqrt(references.shape[0])))
+        centroids = references[rng.choice(references.shape[0], cluster_count, replace=False)].toarray()
+
+        assignment = np.zeros(references.shape[0], dtype=np.int32)
+        for _ in range(DefaultValues.REF_ANN_ITERATIONS):
+            assignment = np.argmax(references @ centroids.T, axis=1).astype(np.int32)
+            members = csr_matrix((np.ones(len(assignment)), (assignment, np.arange(len(assignment)))),
+                                 shape=(cluster_count, references.shape[0]))
+            sums = np.asarray((members @ references).todense())
+            norms = np.linalg.norm(sums, axis=1)
+            # empty clusters keep their previous centroid
+            filled = norms > 0
+            centroids[filled] = sums[filled] / norms[filled, np.newaxis]
+
+        return assignment
+
+    def cluster_assignment(self):
+        '''Cluster of every reference row.'''
+
+        if self.__assignment is not None:
+            return self.__assignment
+
+        assignment = None
+        if self.__stored:
+            try:
+                assignment = np.load(os.path.join(DefaultValues.REF_INDEX_LOCATION, 'clusters.npy'))
+                if len(assignment) != self.references.shape[0]:
+                    raise ValueError('cluster assignment does not match reference index')
+            except (OSError, ValueError) as e:
+                logging.debug('Clustering reference index: {}'.format(e))
+                assignment = None
+        if assignment is None:
+            assignment = self.__cluster(self.references)
+
+        self.__assignment = assignment
+        return assignment
+
+    def __load_clusters(self):
+        assignment = self.cluster_assignment()
 
-        csm = self.__calculate_sparse_CSM(self.ref_data[:, :20021], csr_matrix(feature_vector[:, :20021]))
+        # references sorted by cluster, so each cluster is a contiguous block of rows
+        order = np.argsort(assignment, kind='stable')
+        offsets = np.searchsorted(assignment[order], np.arange(assignment.max() + 2))
+        grouped = self.references[order]
+
+        members = csr_matrix((np.ones(len(assignment)), (assignment, np.arange(len(assignment)))),
+                             shape=(len(offsets) - 1, len(assignment)))
+        centroids = np.asarray((members @ self.references).todense())
+        norms = np.linalg.norm(centroids, axis=1)
+        norms[norms == 0] = 1
+        centroids = (centroids / norms[:, np.newaxis]).astype(np.float32)
+
+        self.clusters = (grouped, offsets, centroids)
+
+    def approximate_max_similarity(self, feature_vectors, probes=DefaultValues.REF_ANN_PROBES):
+        '''Approximate cosine similarity of each feature vector to its closest reference genome, searching only
+        the references in the clusters closest to it.'''
+
+        with ReferenceIndex.__lock:
+            if self.clusters is None:
+                self.__load_clusters()
+        grouped, offsets, centroids = self.clusters
+        probes = min(probes, len(centroids))
+
+        queries = csr_matrix(feature_vectors)[:, :self.FEATURE_COUNT]
+        query_norms = np.sqrt(np.asarray(queries.multiply(queries).sum(axis=1)).ravel())
+
+        block_size = max(1, int(DefaultValues.REF_QUERY_BLOCK_MB * 1e6 // (8 * (len(centroids) + self.FEATURE_COUNT))))
+
+        best = np.zeros(queries.shape[0])
+        for start in range(0, queries.shape[0], block_size):
+            block = queries[start:start + block_size].toarray()
+            nearest = np.argpartition(-(block @ centroids.T), probes - 1, axis=1)[:, :probes]
+
+            # search cluster by cluster, for all queries of the block probing it
+            block_best = np.zeros(len(block))
+            for cluster in np.unique(nearest):
+                probing = np.where((nearest == cluster).any(axis=1))[0]
+                similarities = grouped[offsets[cluster]:offsets[cluster + 1]] @ block[probing].T
+                if similarities.shape[0] > 0:
+                    block_best[probing] = np.maximum(block_best[probing], np.amax(similarities, axis=0))
+            best[start:start + block_size] = block_best
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return best / query_norms
+
+
+class modelProcessor:
+
+    def __init__(self, threads=1, approximate=False, compare_exact=False):
+        # self.logger = logging.getLogger('timestamp')
+
+        self.reference_index = ReferenceIndex.load()
+
+        self.threads = threads
+        self.reduced_cutoff = DefaultValues.AA_RATIO_COMPLETENESS_CUTOFF
+        self.approximate = approximate
+        self.compare_exact = compare_exact
+
+    def __calculate_cosine_similarity(self, feature_vector):
         # return array of closest matches in ref database
+        if self.approximate:
+            return self.reference_index.approximate_max_similarity(feature_vector)
+        return self.reference_index.max_similarity(feature_vector)
 
-        return np.amax(csm, axis=0)
+    def __report_approximation(self, feature_vector, comp_results):
+        '''DEBUG: compare approximate reference similarities and model choices against the exact search.'''
 
-    def cosine_decider(self, row):
-        
-        general = row['General']
-        specific = row['Specific']
-        cosine = row['Cosine_Similarity']
-        AA_ratio = row['AA_Ratio']
-        novelty_ratio = general / (cosine ** 2)
+        exact_similarity = self.reference_index.max_similarity(feature_vector)
+        _, exact_model_chosen = self.cosine_decider(comp_results['General'].values, comp_results['Specific'].values,
+                                                    exact_similarity, comp_results['AA_Ratio'].values)
+
+        shortfall = np.nan_to_num(exact_similarity - comp_results['Cosine_Similarity'].values)
+        recall = np.mean(shortfall <= 1e-6)
+        changed = np.sum(exact_model_chosen != comp_results['Model_Chosen'].values)
+
+        logging.info('Approximate reference search: exact nearest reference found for {:.1%} of {} genomes; '
+                     'similarity shortfall mean {:.4f}, max {:.4f}; model choice changed for {} genomes.'.format(
+                      recall, len(shortfall), np.mean(shortfall), np.max(shortfall), changed))
+
+    # (lower bound on mean completeness, novelty ratio below which the specific model is used), checked in order
+    NOVELTY_BANDS = [(90, 160), (80, 165), (70, 165), (60, 170), (50, 175), (40, 175)]
+
+    def cosine_decider(self, general, specific, cosine, AA_ratio):
+        '''Choose between general and specific completeness predictions for arrays of genomes. Returns the chosen
+        completeness and the name of the model used.'''
+
+        # decide in double precision, as the specific model predicts in single precision
+        general, specific, cosine, AA_ratio = [np.asarray(x, dtype=np.float64) for x in
+                                               (general, specific, cosine, AA_ratio)]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            novelty_ratio = general / (cosine ** 2)
 
         meancomp = (general + specific) / 2
 
+        #unfamiliar highly reduced genomes - therefore need to use general model
+        reduced = (meancomp < 55) & (AA_ratio < self.reduced_cutoff)
 
-        if (meancomp < 55) and (AA_ratio < self.reduced_cutoff):
-            #unfamiliar highly reduced genome - therefore needs to use general model
-            return general, 'Gradient Boost (General Model)'
-            
-        else:
-          if meancomp > 90:
-            if novelty_ratio < 160:
-                return specific, 'Neural Network (Specific Model)'
-            else:
-                return general, 'Gradient Boost (General Model)'
-           
-          if meancomp > 80:
-              if novelty_ratio < 165:
-                  return specific, 'Neural Network (Specific Model)'
-              else:
-                  return general, 'Gradient Boost (General Model)'
-          if meancomp > 70:
-              if novelty_ratio < 165:
-                  return specific, 'Neural Network (Specific Model)'
-              else:
-                  return general, 'Gradient Boost (General Model)'
-          if meancomp > 60:
-              if novelty_ratio < 170:
-                  return specific, 'Neural Network (Specific Model)'
-              else:
-                  return general, 'Gradient Boost (General Model)'
-          if meancomp > 50:
-              if novelty_ratio < 175:
-                  return specific, 'Neural Network (Specific Model)'
-              else:
-                  return general, 'Gradient Boost (General Model)'
-          if meancomp > 40:
-              if novelty_ratio < 175:
-                  return specific, 'Neural Network (Specific Model)'
-              else:
-                  return general, 'Gradient Boost (General Model)'
-          else:
-              return specific, 'Neural Network (Specific Model)'
+        # genomes below the lowest band use the specific model
+        use_specific = np.select([reduced] + [meancomp > band for band, _ in self.NOVELTY_BANDS],
+                                 [False] + [novelty_ratio < cutoff for _, cutoff in self.NOVELTY_BANDS],
+                                 default=True)
+
+        completeness = np.where(use_specific, specific, general)
+        model_chosen = np.where(use_specific, 'Neural Network (Specific Model)',
+                                'Gradient Boost (General Model)').astype(object)
+
+        return completeness, model_chosen
         
 
     def calculate_general_specific_ratio(self, AA_counts, feature_vector, general_comp, contamination, specific_comp):
@@ -113,7 +305,12 @@ class modelProcessor:
                                      'AA_Ratio': completeness_AA_ratio})
                                      
 
-        comp_results[['CheckM2_Completeness', 'Model_Chosen']] = comp_results.apply(self.cosine_decider, axis=1, result_type='expand')
+        comp_results['CheckM2_Completeness'], comp_results['Model_Chosen'] = self.cosine_decider(
+            comp_results['General'].values, comp_results['Specific'].values, csm_array,
+            comp_results['AA_Ratio'].values)
+
+        if self.approximate and self.compare_exact:
+            self.__report_approximation(csr_matrix(feature_vector), comp_results)
         
         return comp_results['CheckM2_Completeness'].values, contamination, comp_results['Model_Chosen'].values, comp_results['Cosine_Similarity'].values
 
@@ -8,15 +8,18 @@ warnings.simplefilter(action='ignore', category=pd.errors.PerformanceWarning)
 
 from checkm2.defaultValues import DefaultValues
 # import xgboost as xgb
-import lightgbm as lgb
 import os
 
 #make sure we're only using CPUs as GPUs can throw weird errors and is not worth the minor speed advantage
 os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
 
-from tensorflow import keras
+from checkm2 import numpyNetwork
+from checkm2 import treeEnsemble
+from checkm2 import modelBundle
+from checkm2 import fileManager
 
 from sklearn.preprocessing import MinMaxScaler
+from scipy.sparse import csr_matrix
 import pickle
 import logging
 import sys
@@ -32,12 +35,28 @@ class modelProcessor:
         self.nthreads = threads
 
         try:
-            self.general_model_comp = lgb.Booster(model_file=DefaultValues.GENERAL_MODEL_COMP_LOCATION)
-            self.model_cont = lgb.Booster(model_file=DefaultValues.MODEL_CONT_LOCATION)
+            # everything is memory-mapped from one file if it was compiled with <checkm2 models --compile>
+            bundle = modelBundle.ModelBundle.load()
 
-            self.specific_model_comp_nn = keras.models.load_model(DefaultValues.SPECIFIC_MODEL_COMP_LOCATION)
+            if bundle is not None:
+                self.general_models = treeEnsemble.TreeEnsemble(model_strings=bundle.booster_strings())
+                self.specific_model_comp_nn = bundle.network(float32=DefaultValues.NUMPY_NETWORK_FLOAT32)
+                self.numpy_network = True
+                self.minmax_scaler = bundle.scaler()
 
-            self.minmax_scaler = pickle.load(open(DefaultValues.SCALER_FILE_LOCATION, 'rb'))
+            else:
+                # completeness and contamination boosters, predicted from one sparse copy of the features they use
+                self.general_models = treeEnsemble.TreeEnsemble([DefaultValues.GENERAL_MODEL_COMP_LOCATION,
+                                                                 DefaultValues.MODEL_CONT_LOCATION])
+
+                # TensorFlow is only imported if the network hasn't been exported with <checkm2 models --export>
+                self.specific_model_comp_nn = numpyNetwork.NumpyNetwork.load(float32=DefaultValues.NUMPY_NETWORK_FLOAT32)
+                self.numpy_network = self.specific_model_comp_nn is not None
+                if not self.numpy_network:
+                    from tensorflow import keras
+                    self.specific_model_comp_nn = keras.models.load_model(DefaultValues.SPECIFIC_MODEL_COMP_LOCATION)
+
+                self.minmax_scaler = pickle.load(open(DefaultValues.SCALER_FILE_LOCATION, 'rb'))
             
 
             if logging.root.level == logging.DEBUG:
@@ -49,15 +68,24 @@ class modelProcessor:
             logging.error("Saved models could not be loaded: {}".format(e))
             sys.exit(1)
 
+    @staticmethod
+    def check_model_files():
+        '''Exit if a model file is missing, without loading the models.'''
+
+        for location in [DefaultValues.GENERAL_MODEL_COMP_LOCATION, DefaultValues.MODEL_CONT_LOCATION,
+                         DefaultValues.SCALER_FILE_LOCATION]:
+            fileManager.check_if_file_exists(location)
+        if not os.path.exists(DefaultValues.SPECIFIC_MODEL_NUMPY_LOCATION):
+            fileManager.check_if_file_exists(DefaultValues.SPECIFIC_MODEL_COMP_LOCATION)
+
     def run_prediction_general(self, vector_array):
         
         #TODO: make sure runs on 1 sample
 
-        comp_predictions = self.general_model_comp.predict(vector_array, n_jobs=self.nthreads)
+        predictions = self.general_models.predict(vector_array, self.nthreads)
+        comp_predictions, cont_predictions = predictions[:, 0], predictions[:, 1]
         comp_predictions[comp_predictions > 100] = 100
 
-        cont_predictions = self.model_cont.predict(vector_array, n_jobs=self.nthreads)
-
         comp_predictions[comp_predictions < 0] = 0
         cont_predictions[cont_predictions < 0] = 0
 
@@ -72,8 +100,11 @@ class modelProcessor:
 
         # only using genes for specific predictions
 
-        comp_predictions = self.specific_model_comp_nn.predict(scaled_vector[:, :specific_model_vector_len],
-                                                               verbose=self.verbosity)
+        specific_vector = scaled_vector[:, :specific_model_vector_len]
+        if self.numpy_network and self.specific_model_comp_nn.sparse_input:
+            specific_vector = csr_matrix(specific_vector.reshape(specific_vector.shape[0], -1))
+
+        comp_predictions = self.specific_model_comp_nn.predict(specific_vector, verbose=self.verbosity)
 
         # as we're using sigmoid output for completeness model, convert to 100-scale
         comp_predictions = comp_predictions * 100
@@ -0,0 +1,249 @@
+from checkm2.defaultValues import DefaultValues
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import numpy as np
+from scipy import sparse
+
+
+class NumpyNetwork():
+
+    ''' Forward pass of the specific completeness network in NumPy, so predictions don't need TensorFlow.
+
+        The network is exported once from the Keras model (checkm2 models --export) into SPECIFIC_MODEL_NUMPY_LOCATION
+        as a list of layers with their settings and weights. Only layers of sequential networks are supported:
+        Dense, Conv1D, MaxPooling1D, AveragePooling1D, Flatten, Reshape, BatchNormalization and Activation, while
+        Dropout and noise layers are skipped as they are at inference. Export fails for anything else.
+
+        Genomes are predicted in batches sized to NUMPY_NETWORK_BATCH_MB of activations, in float64 unless float32
+        is requested. If the input goes into the first Dense layer as a flat vector, either because it is
+        1-dimensional or because only Flatten layers come before, sparse input is multiplied without densifying it.
+    '''
+
+    SKIPPED_LAYERS = ['InputLayer', 'Dropout', 'SpatialDropout1D', 'GaussianNoise', 'GaussianDropout', 'AlphaDropout']
+
+    ACTIVATIONS = {
+        'linear': lambda x: x,
+        'relu': lambda x: np.maximum(x, 0),
+        'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+        'tanh': np.tanh,
+        'softplus': lambda x: np.logaddexp(0, x),
+        'elu': lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+        'selu': lambda x: 1.0507009873554805 * np.where(x > 0, x, 1.6732632423543772 * np.expm1(np.minimum(x, 0))),
+        'swish': lambda x: x / (1 + np.exp(-x)),
+        'softmax': lambda x: np.exp(x - x.max(axis=-1, keepdims=True)) /
+                             np.exp(x - x.max(axis=-1, keepdims=True)).sum(axis=-1, keepdims=True),
+    }
+
+    def __init__(self, layers, weights, input_shape, float32=False):
+        self.layers = layers
+        self.dtype = np.float32 if float32 else np.float64
+        # weights already in the right precision aren't copied, so memory-mapped weights stay shared
+        self.weights = [[np.asarray(w, dtype=self.dtype) for w in layer_weights] for layer_weights in weights]
+        self.input_shape = tuple(input_shape)
+
+        # sparse input only helps if it goes straight into a matrix product, which Dense layers only do for
+        # flat input; on other input they act on the last axis
+        self.sparse_input = False
+        flat = len(self.input_shape) == 1
+        for layer in self.layers:
+            if layer['type'] == 'Dense':
+                self.sparse_input = flat
+            if layer['type'] != 'Flatten':
+                break
+            flat = True
+
+        # activations of one genome, to size batches
+        self.__sample_size = 0
+        self.output_shape = self.__forward(np.zeros((1,) + self.input_shape, dtype=self.dtype),
+                                           record_size=True).shape[1:]
+
+    @staticmethod
+    def source_checksum(location=DefaultValues.SPECIFIC_MODEL_COMP_LOCATION):
+        sha256_hash = hashlib.sha256()
+        with open(location, 'rb') as f:
+            for byte_block in iter(lambda: f.read(1 << 20), b""):
+                sha256_hash.update(byte_block)
+        return sha256_hash.hexdigest()
+
+    @classmethod
+    def from_keras(cls, model, float32=False):
+        '''Convert a sequential Keras model.'''
+
+        layers, weights = [], []
+        for keras_layer in model.layers:
+            layer_type = keras_layer.__class__.__name__
+            config = keras_layer.get_config()
+            if layer_type in cls.SKIPPED_LAYERS:
+                continue
+
+            layer = {'type': layer_type}
+            if layer_type in ['Dense', 'Conv1D', 'Activation']:
+                layer['activation'] = config['activation']
+                if layer['activation'] not in cls.ACTIVATIONS:
+                    raise ValueError('activation {} of layer {} is not supported'.format(config['activation'],
+                                                                                        keras_layer.name))
+            if layer_type in ['Dense', 'Conv1D']:
+                layer['use_bias'] = config['use_bias']
+
+            if layer_type == 'Conv1D':
+                if config.get('data_format', 'channels_last') != 'channels_last' or config.get('groups', 1) != 1:
+                    raise ValueError('only channels_last, ungrouped convolutions are supported')
+                layer.update({'strides': config['strides'][0], 'padding': config['padding'],
+                              'dilation_rate': config['dilation_rate'][0]})
+            elif layer_type in ['MaxPooling1D', 'AveragePooling1D']:
+                if config.get('data_format', 'channels_last') != 'channels_last':
+                    raise ValueError('only channels_last pooling is supported')
+                layer.update({'pool_size': config['pool_size'][0], 'strides': config['strides'][0],
+                              'padding': config['padding']})
+            elif layer_type == 'Reshape':
+                layer['target_shape'] = list(config['target_shape'])
+            elif layer_type == 'BatchNormalization':
+                axis = config['axis'][0] if isinstance(config['axis'], (list, tuple)) else config['axis']
+                if axis not in [-1, len(keras_layer.input_shape) - 1]:
+                    raise ValueError('only batch normalisation over the last axis is supported')
+                layer.update({'epsilon': config['epsilon'], 'center': config['center'], 'scale': config['scale']})
+            elif layer_type not in ['Dense', 'Flatten', 'Activation']:
+                raise ValueError('layer {} of type {} is not supported'.format(keras_layer.name, layer_type))
+
+            layers.append(layer)
+            weights.append([np.asarray(w) for w in keras_layer.get_weights()])
+
+        return cls(layers, weights, model.input_shape[1:], float32)
+
+    def save(self, location=DefaultValues.SPECIFIC_MODEL_NUMPY_LOCATION, source_checksum=None):
+        arrays = {'layer_{}_{}'.format(i, j): w for i, layer_weights in enumerate(self.weights)
+                  for j, w in enumerate(layer_weights)}
+        header = {'layers': self.layers, 'weight_counts': [len(w) for w in self.weights],
+                  'input_shape': list(self.input_shape), 'source_sha256': source_checksum}
+
+        # write atomically, so concurrent runs never load a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(location), suffix='.npz')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, header=np.array(json.dumps(header)), **arrays)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, location)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @classmethod
+    def load(cls, location=DefaultValues.SPECIFIC_MODEL_NUMPY_LOCATION, float32=False):
+        '''Load an exported network, or return None if there is none or it was exported from a different Keras
+        model.'''
+
+        if not os.path.exists(location):
+            return None
+
+        with np.load(location) as exported:
+            header = json.loads(str(exported['header']))
+            weights = [[exported['layer_{}_{}'.format(i, j)] for j in range(count)]
+                       for i, count in enumerate(header['weight_counts'])]
+
+        if os.path.exists(DefaultValues.SPECIFIC_MODEL_COMP_LOCATION) and \
+                header['source_sha256'] != cls.source_checksum(DefaultValues.SPECIFIC_MODEL_COMP_LOCATION):
+            logging.warning('Exported network {} does not match {}; using Keras instead. Run "checkm2 models --export" '
+                            'to export it again.'.format(location, DefaultValues.SPECIFIC_MODEL_COMP_LOCATION))
+            return None
+
+        return cls(header['layers'], weights, header['input_shape'], float32)
+
+    def __pad(self, x, size, strides, dilation_rate, padding, value=0):
+        # pad the steps axis of (batch, steps, channels) as Keras does
+        span = (size - 1) * dilation_rate + 1
+        steps = x.shape[1]
+        if padding == 'same':
+            out_steps = -(-steps // strides)
+            total = max(0, (out_steps - 1) * strides + span - steps)
+            x = np.pad(x, ((0, 0), (total // 2, total - total // 2), (0, 0)), constant_values=value)
+        elif padding == 'causal':
+            x = np.pad(x, ((0, 0), (span - 1, 0), (0, 0)), constant_values=value)
+        return x
+
+    def __windows(self, x, size, strides, dilation_rate=1):
+        # (batch, out_steps, size, channels) view of x without copying
+        x = np.ascontiguousarray(x)
+        span = (size - 1) * dilation_rate + 1
+        out_steps = (x.shape[1] - span) // strides + 1
+        return np.lib.stride_tricks.as_strided(
+            x, shape=(x.shape[0], out_steps, size, x.shape[2]),
+            strides=(x.strides[0], x.strides[1] * strides, x.strides[1] * dilation_rate, x.strides[2]),
+            writeable=False)
+
+    def __forward(self, x, record_size=False):
+        for layer, weights in zip(self.layers, self.weights):
+            layer_type = layer['type']
+
+            with np.errstate(over='ignore'):
+                if layer_type == 'Dense':
+                    x = x @ weights[0]
+                    if layer['use_bias']:
+                        x = x + weights[1]
+                    x = self.ACTIVATIONS[layer['activation']](x)
+
+                elif layer_type == 'Conv1D':
+                    kernel = weights[0]
+                    x = self.__pad(x, kernel.shape[0], layer['strides'], layer['dilation_rate'], layer['padding'])
+                    windows = self.__windows(x, kernel.shape[0], layer['strides'], layer['dilation_rate'])
+                    x = np.tensordot(windows, kernel, axes=([2, 3], [0, 1]))
+                    if layer['use_bias']:
+                        x = x + weights[1]
+                    x = self.ACTIVATIONS[layer['activation']](x)
+
+                elif layer_type in ['MaxPooling1D', 'AveragePooling1D']:
+                    size, strides, padding = layer['pool_size'], layer['strides'], layer['padding']
+                    if layer_type == 'MaxPooling1D':
+                        # padded steps never win a maximum
+                        x = self.__windows(self.__pad(x, size, strides, 1, padding, -np.inf), size, strides).max(axis=2)
+                    else:
+                        # and are not counted in an average
+                        counts = self.__pad(np.ones((1, x.shape[1], 1), dtype=self.dtype), size, strides, 1, padding)
+                        x = self.__windows(self.__pad(x, size, strides, 1, padding), size, strides).sum(axis=2) / \
+                            self.__windows(counts, size, strides).sum(axis=2)
+
+                elif layer_type == 'Flatten':
+                    x = x.reshape(x.shape[0], -1)
+
+                elif layer_type == 'Reshape':
+                    x = x.reshape((x.shape[0],) + tuple(layer['target_shape']))
+
+                elif layer_type == 'BatchNormalization':
+                    weights = list(weights)
+                    gamma = weights.pop(0) if layer['scale'] else 1
+                    beta = weights.pop(0) if layer['center'] else 0
+                    mean, variance = weights
+                    x = (x - mean) / np.sqrt(variance + layer['epsilon']) * gamma + beta
+
+                elif layer_type == 'Activation':
+                    x = self.ACTIVATIONS[layer['activation']](x)
+
+            if record_size:
+                self.__sample_size = max(self.__sample_size, x.size * x.itemsize)
+
+        return x
+
+    def predict(self, x, verbose=0):
+        '''Predict a (genomes, features) or (genomes, features, 1) array, or a sparse (genomes, features) matrix,
+        in the same way as keras.Model.predict.'''
+
+        if not sparse.issparse(x):
+            x = np.asarray(x, dtype=self.dtype)
+        elif not self.sparse_input:
+            x = x.toarray().astype(self.dtype)
+        else:
+            x = sparse.csr_matrix(x, dtype=self.dtype)
+
+        batch_size = max(1, int(DefaultValues.NUMPY_NETWORK_BATCH_MB * 1e6 // max(1, self.__sample_size)))
+
+        predictions = [np.zeros((0,) + self.output_shape, dtype=self.dtype)]
+        for start in range(0, x.shape[0], batch_size):
+            batch = x[start:start + batch_size]
+            if not sparse.issparse(batch):
+                batch = batch.reshape((batch.shape[0],) + self.input_shape)
+            predictions.append(self.__forward(batch))
+
+        return np.concatenate(predictions)
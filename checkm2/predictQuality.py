@@ -2,11 +2,14 @@ from checkm2 import modelProcessing
 from checkm2 import metadata
 from checkm2 import prodigal
 from checkm2 import diamond
+from checkm2.resourcePlanner import ResourcePlanner
 from checkm2.defaultValues import DefaultValues
 from checkm2.versionControl import VersionControl
 from checkm2 import keggData
 from checkm2 import modelPostprocessing
 from checkm2 import fileManager
+from checkm2 import genomeCache
+from checkm2 import proteinCache
 
 import os
 import multiprocessing as mp
@@ -16,15 +19,24 @@ import sys
 import logging
 import pandas as pd
 import tarfile
+import time
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 # For unnessesary tensorflow warnings:
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 logging.getLogger('tensorflow').setLevel(logging.FATAL)
 
+# Order of the per-genome records returned by ProdigalRunner.run
+GENOME_STATS_COLUMNS = ['Name', 'Translation_Table_Used', 'Coding_Density', 'Contig_N50', 'Average_Gene_Length',
+                        'Genome_Size', 'Total_Coding_Sequences', 'GC_Content', 'Total_Contigs', 'Max_Contig_Length']
 
 
 class Predictor():
-    def __init__(self, bin_folder, outdir, bin_extension='.fna', threads=1, lowmem=False, tempDBloc=None):
+    def __init__(self, bin_folder, outdir, bin_extension='.fna', threads=1, lowmem=False, tempDBloc=None,
+                 streaming=False, cache_dir=None, cache_max_size=DefaultValues.GENOME_CACHE_MAX_SIZE_GB,
+                 memory_limit=None):
 
         self.bin_folder = bin_folder
         self.bin_extension = bin_extension
@@ -38,9 +50,16 @@ class Predictor():
         if self.lowmem:
           logging.info('Running in low-memory mode.')
 
+        self.cache_dir = cache_dir
+        self.cache_max_size = cache_max_size
 
         self.total_threads = threads
 
+        # streaming splits the threads between gene calling and DIAMOND, so it needs at least one for each
+        self.streaming = streaming and self.total_threads > 1
+        if streaming and not self.streaming:
+            logging.info('Streaming mode needs at least 2 threads. Calling genes and annotating one after the other.')
+
         logging.debug('Verifying internal checksums for all models, scalers and reference data.')
         #if VersionControl().checksum_version_validate() is False:
         #    logging.error('Could not verify internal model checksums. Please re-download CheckM2.')
@@ -59,6 +78,10 @@ class Predictor():
 
         fileManager.check_if_file_exists(self.diamond_path)
 
+        self.planner = ResourcePlanner(self.total_threads, self.diamond_path, self.lowmem, memory_limit)
+        if memory_limit is not None:
+            logging.info('Planning DIAMOND and inference settings for a memory limit of {} GB.'.format(memory_limit))
+
 
     def __setup_bins(self):
         bin_files = []
@@ -81,28 +104,76 @@ class Predictor():
         return sorted(bin_files)
 
     def prediction_wf(self, genes_supplied=False, mode='auto', debug_cos=False,
-                      dumpvectors=False, stdout=False, resume=False, remove_intermediates=False, ttable=None):
+                      dumpvectors=False, stdout=False, resume=False, remove_intermediates=False, ttable=None,
+                      ann=False, debug_ann=False, keep_gene_files=False, debug_ttable=False, ttable_prescreen=False):
+
+        #make sure models are there; they are loaded in the background once worker processes have been forked
+        modelProcessing.modelProcessor.check_model_files()
+        self.__model_loader = None
 
-        #make sure models can be loaded without problems
-        modelProc = modelProcessing.modelProcessor(self.total_threads)
+        annotation_cache = None
+        if self.cache_dir is not None and not resume:
+            annotation_cache = proteinCache.ProteinAnnotationCache(self.cache_dir, self.diamond_path)
 
         #make sure diamond is set up and ready to go
-        diamond_search = diamond.DiamondRunner(self.total_threads, self.output_folder, self.lowmem, self.diamond_path)
+        diamond_search = diamond.DiamondRunner(self.total_threads, self.output_folder, self.lowmem, self.diamond_path,
+                                               annotation_cache, self.planner)
+
+
+
+        metadata_records, diamond_out = None, None
 
+        # bins to call genes for, with the translation table to use for each
+        jobs = [(bin_file, ttable) for bin_file in self.bin_files]
 
+        # with debug_ttable, genes are called with both translation tables to check the translation table pre-screen
+        self.debug_ttable = debug_ttable and ttable is None
+        self.ttable_prescreen = ttable_prescreen and ttable is None
+
+        # nucleotide gene sequences and GFF output of Prodigal are only written if they are kept
+        self.gene_files_folder = None
+        if keep_gene_files:
+            if resume or genes_supplied:
+                logging.warning('Gene files are only written when calling genes from nucleotide input without --resume. '
+                                'Ignoring --keep_gene_files.')
+            else:
+                self.gene_files_folder = os.path.join(self.output_folder, DefaultValues.GENE_FILES_FOLDER_NAME)
+                fileManager.make_sure_path_exists(self.gene_files_folder)
+                if self.cache_dir is not None:
+                    logging.info('Gene files are not written for bins found in the genome cache.')
+
+        cache, cached = None, None
+        if self.cache_dir is not None:
+            if resume or genes_supplied:
+                logging.warning('The genome cache is only used when calling genes from nucleotide input without --resume. '
+                                'Ignoring --cache_dir.')
+            else:
+                cache = genomeCache.GenomeCache(self.cache_dir, self.diamond_path, ttable, ann, self.ttable_prescreen)
+                jobs, cached = self.__check_genome_cache(cache, ttable)
 
         ''' 1: Call genes and automatically determine coding table'''
         if resume:
             logging.info('Re-using protein files from output directory: {}'.format(self.prodigal_folder,))
             prodigal_files = [os.path.join(self.prodigal_folder, bin_file) for bin_file in os.listdir(self.prodigal_folder)]
 
+        elif not genes_supplied and len(jobs) == 0:
+            logging.info('All bins were found in the genome cache. Skipping gene calling and annotation.')
+            stats_records, metadata_records, diamond_out, prodigal_files = [], [], [], []
+
+        elif not genes_supplied and self.streaming:
+            # gene calling, metadata and DIAMOND annotation (steps 1-3) overlap in streaming mode
+            stats_records, metadata_records, diamond_out = self.__run_streaming_pipeline(jobs, diamond_search)
+
+            prodigal_files, used_ttables = fileManager.verify_prodigal_output(self.prodigal_folder,
+                                                                              self.__build_stats_table(stats_records)['Translation_Table_Used'].to_dict(),
+                                                                              self.bin_extension)
+
         elif not genes_supplied:
-            used_ttables, coding_density, \
-            N50, avg_gene_len, \
-            total_bases, cds_count, \
-            GC, totalContigs, maxContigLen = self.__run_prodigal(ttable)
+            stats_records = self.__run_prodigal(jobs)
 
-            prodigal_files, used_ttables = fileManager.verify_prodigal_output(self.prodigal_folder, used_ttables, self.bin_extension)
+            prodigal_files, used_ttables = fileManager.verify_prodigal_output(self.prodigal_folder,
+                                                                              self.__build_stats_table(stats_records)['Translation_Table_Used'].to_dict(),
+                                                                              self.bin_extension)
 
         else:
             logging.info('Using user-supplied protein files.')
@@ -113,9 +184,22 @@ class Predictor():
 
         ''' 2: Calculate genome metadata from protein files'''
 
-        metadata_df = self.__calculate_metadata(prodigal_files)
-        metadata_df = pd.concat(metadata_df.values())
-        metadata_df.reset_index(drop=True, inplace=True)
+        if metadata_records is None:
+            metadata_records = self.__calculate_metadata(prodigal_files)
+
+        if cached is not None:
+            self.__store_genes(cache, cached, stats_records, metadata_records)
+            # genomes with cached annotations only need to go through the models
+            stats_records = stats_records + [record['stats'] for record in cached['genes'].values()]
+            metadata_records = metadata_records + [cached['genes'][name]['metadata'] for name in cached['kos']]
+
+        if not genes_supplied and not resume:
+            genome_stats = self.__build_stats_table(stats_records)
+
+        metadata_df = self.__build_metadata_table(metadata_records)
+
+        # no more worker processes are forked from here on
+        self.__load_models_in_background()
 
         # make sure metadata is arranged correctly
         metadata_order = keggData.KeggCalculator().return_proper_order('Metadata')
@@ -124,6 +208,12 @@ class Predictor():
 
         ''' 3: Determine all KEGG annotations of input genomes using DIAMOND blastp'''
 
+        ''' Get a list of default KO id's from data
+            Available categories are the keys in DefaultValues.feature_ordering
+            Here, returns an ordered set of KEGG ID's and sets to 0 
+        '''
+        KO_list = keggData.KeggCalculator().return_feature_index('KO_Genes')
+
         if resume:
             logging.info("Reusing DIAMOND output from output directory: {}".format(diamond_search.diamond_out))
                 
@@ -131,41 +221,18 @@ class Predictor():
             if len(diamond_out) == 0:
                 logging.error("No DIAMOND outputs have been found in {}. Resuming is not possible.".format(diamond_search.diamond_out))
                 exit(1)
-        else:
-            diamond_out = diamond_search.run(prodigal_files)
-
-        ### MOVED
-
-        logging.info('Processing DIAMOND output')
-        # concatenate all results even if only one
-        results = pd.concat([pd.read_csv(os.path.join(diamond_search.diamond_out, entry), sep='\t', usecols=[0, 1],
-                                         names=['header', 'annotation']) for entry in diamond_out])
-
-        if len(results) < 1:
-            logging.error('No DIAMOND annotation was generated. Exiting')
-            sys.exit(1)
-
-        # Split columns into usable series
-        results[['GenomeName', 'ProteinID']] = results['header'].str.split(diamond_search.separator, 1, expand=True)
-        results[['Ref100_hit', 'Kegg_annotation']] = results['annotation'].str.split('~', 1, expand=True)
-
-        ''' Get a list of default KO id's from data
-            Available categories are the keys in DefaultValues.feature_ordering
-            Here, returns an ordered set of KEGG ID's and sets to 0 
-        '''
-        KeggCalc = keggData.KeggCalculator()
-        defaultKOs = KeggCalc.return_default_values_from_category('KO_Genes')
-
-        # Remove from results any KOs we're not currently using
-        results = results[results['Kegg_annotation'].isin(defaultKOs.keys())]
-
-        # Update counts per genome
+        elif diamond_out is None:
+            diamond_out = diamond_search.run(prodigal_files, dict((record[0], record[2]) for record in metadata_records))
 
         full_name_list = metadata_df['Name'].values
-        #kegg_genome_list = []
+        metadata_array = metadata_df.iloc[:, 1:].values
+
+        # genomes x KOs count matrix, rows aligned with metadata_df
+        KO_matrix = diamond_search.build_KO_matrix(diamond_out, full_name_list, KO_list,
+                                                   cached['kos'] if cached is not None else None)
 
-        annot_dict = dict(
-            zip(sorted(results['GenomeName'].unique()), [x for _, x in results.groupby(results['GenomeName'])]))
+        if cached is not None:
+            self.__store_KO_counts(cache, cached, prodigal_files, KO_matrix, full_name_list, KO_list)
 
         logging.info('Predicting completeness and contamination using ML models.')
 
@@ -173,41 +240,27 @@ class Predictor():
         general_results_comp, specific_results_comp = [], [], [], [], [], [], []
 
         chunk_counter = 0
+        modelProc = self.__wait_for_models()
+        postProcessor = modelPostprocessing.modelProcessor(self.total_threads, ann, debug_ann)
+        inference_chunk = self.planner.plan_inference(len(full_name_list))
 
-        for i in range(0, len(full_name_list), DefaultValues.KO_FEATURE_VECTOR_CHUNK):
-            sublist = full_name_list[i:i + DefaultValues.KO_FEATURE_VECTOR_CHUNK]
+        for i in range(0, len(full_name_list), inference_chunk):
+            sublist = full_name_list[i:i + inference_chunk]
             chunk_counter += 1
 
+            KO_features = diamond_search.process_diamond_output(KO_matrix[i:i + inference_chunk])
 
-            parsed_diamond_results, ko_list_length = diamond_search.process_diamond_output(defaultKOs, annot_dict, sublist)
-
-
-            parsed_diamond_results.sort_values(by='Name', inplace=True)
-
-            sub_metadata = metadata_df[metadata_df['Name'].isin(sublist)]
-
-            sub_metadata.sort_values(by='Name', inplace=True)
-            parsed_diamond_results.sort_values(by='Name', inplace=True)
-            parsed_diamond_results.reset_index(drop=True, inplace=True)
-            sub_metadata.reset_index(drop=True, inplace=True)
-
-            names.append(parsed_diamond_results['Name'].values)
-
-            # delete duplicate 'name' column and merge
-            del parsed_diamond_results['Name']
-
-            feature_vectors = pd.concat([sub_metadata[sub_metadata['Name'].isin(sublist)], parsed_diamond_results], axis=1)
-            #print(feature_vectors.shape)
+            names.append(sublist)
 
             ''' 4: Call general model & specific models and derive predictions'''
 
-            vector_array = feature_vectors.iloc[:, 1:].values.astype(np.float)
+            vector_array = np.hstack([metadata_array[i:i + inference_chunk], KO_features]).astype(float)
 
 
             general_result_comp, general_result_cont = modelProc.run_prediction_general(vector_array)
 
-            specific_model_vector_len = (ko_list_length + len(
-                metadata_order)) - 1  # -1 = without name TODO a bit ugly - maybe just calculate length on setup somewhere
+            # metadata and KO counts, without pathway, module and category completeness
+            specific_model_vector_len = metadata_array.shape[1] + len(KO_list)
 
 
             # also retrieve scaled data for CSM calculations
@@ -223,7 +276,6 @@ class Predictor():
             if not mode == 'specific' or not mode == 'general':
                 #logging.info('Using cosine simlarity to reference data to select appropriate predictor model.')
 
-                postProcessor = modelPostprocessing.modelProcessor(self.total_threads)
                 final_comp, final_cont, model_chosen, csm_array = postProcessor.calculate_general_specific_ratio(
                     vector_array[:, 20],
                     scaled_features,
@@ -237,19 +289,22 @@ class Predictor():
 
             if dumpvectors:
                 dumpfile = os.path.join(self.output_folder, f'feature_vectors_{chunk_counter}.pkl')
+                feature_vectors = pd.DataFrame(vector_array, columns=self.__feature_names())
+                feature_vectors.insert(0, 'Name', sublist)
                 feature_vectors.to_pickle(dumpfile, protocol=4)
 
         logging.info('Parsing all results and constructing final output table.')
 
 
-        #flatten lists
-        names = [item for sublist in names for item in sublist]
-        final_comps = [item for sublist in final_comps for item in sublist]
-        final_conts = [item for sublist in final_conts for item in sublist]
-        models_chosen = [item for sublist in models_chosen for item in sublist]
-        csm_arrays = [item for sublist in csm_arrays for item in sublist]
-        general_results_comp = [item for sublist in general_results_comp for item in sublist]
-        specific_results_comp = [item for sublist in specific_results_comp for item in sublist]
+        #flatten chunks
+        names, final_comps, final_conts, models_chosen, csm_arrays, general_results_comp, specific_results_comp = \
+            [np.concatenate(chunks) if len(chunks) > 0 else np.array([]) for chunks in
+             (names, final_comps, final_conts, models_chosen, csm_arrays, general_results_comp, specific_results_comp)]
+
+        if cached is not None:
+            names, final_comps, final_conts, models_chosen, csm_arrays, general_results_comp, specific_results_comp = \
+                self.__merge_cached_predictions(cache, cached, names, final_comps, final_conts, models_chosen,
+                                                csm_arrays, general_results_comp, specific_results_comp)
 
 
         final_results = pd.DataFrame({'Name':names})
@@ -278,15 +333,16 @@ class Predictor():
             sys.exit(1)
 
         if not genes_supplied and not resume:
-            final_results['Translation_Table_Used'] = final_results['Name'].apply(lambda x: used_ttables[x])
-            final_results['Coding_Density'] = final_results['Name'].apply(lambda x: np.round(coding_density[x], 3))
-            final_results['Contig_N50'] = final_results['Name'].apply(lambda x: int(N50[x]))
-            final_results['Average_Gene_Length'] = final_results['Name'].apply(lambda x: avg_gene_len[x])
-            final_results['Genome_Size'] = final_results['Name'].apply(lambda x: total_bases[x])
-            final_results['GC_Content'] = final_results['Name'].apply(lambda x: np.round(GC[x], 2))
-            final_results['Total_Coding_Sequences'] = final_results['Name'].apply(lambda x: cds_count[x])
-            final_results['Total_Contigs'] = final_results['Name'].apply(lambda x: totalContigs[x])
-            final_results['Max_Contig_Length'] = final_results['Name'].apply(lambda x: maxContigLen[x])
+            stats = genome_stats.loc[names]
+            final_results['Translation_Table_Used'] = stats['Translation_Table_Used'].values
+            final_results['Coding_Density'] = np.round(stats['Coding_Density'].values, 3)
+            final_results['Contig_N50'] = stats['Contig_N50'].values.astype(int)
+            final_results['Average_Gene_Length'] = stats['Average_Gene_Length'].values
+            final_results['Genome_Size'] = stats['Genome_Size'].values
+            final_results['GC_Content'] = np.round(stats['GC_Content'].values, 2)
+            final_results['Total_Coding_Sequences'] = stats['Total_Coding_Sequences'].values
+            final_results['Total_Contigs'] = stats['Total_Contigs'].values
+            final_results['Max_Contig_Length'] = stats['Max_Contig_Length'].values
 
 
         if debug_cos is True:
@@ -309,206 +365,316 @@ class Predictor():
             shutil.rmtree(self.prodigal_folder)
             shutil.rmtree(diamond_search.diamond_out)
 
+        if cache is not None:
+            cache.prune(self.cache_max_size)
+        if annotation_cache is not None:
+            annotation_cache.prune(self.cache_max_size)
+
         logging.info('CheckM2 finished successfully.')
 
     def __flag_divergent_predictions(self, general, specific, threshold=DefaultValues.MODEL_DIVERGENCE_WARNING_THRESHOLD):
     
-        compare = pd.DataFrame({'General':general, 'Specific':specific})
-        compare['Difference'] = compare.apply(lambda row: abs(row['General'] - row['Specific']), axis=1)
-        compare['Additional_Notes'] = compare.apply(lambda row: 'None' if row['Specific'] < 50 or row['Difference'] < threshold else \
-        'Low confidence prediction - substantial ({}%) disagreement between completeness prediction models'.format(int(row['Difference'])), axis=1)
-        
-        return compare['Additional_Notes'].values
-
-    def __set_up_prodigal_thread(self, queue_in, queue_out, ttable, used_ttable, coding_density,
-                                 N50, avg_gene_len, total_bases, cds_count, GC, totalContigs, maxContigLen):
-
-        while True:
-            bin = queue_in.get(block=True, timeout=None)
-            if bin == None:
-                break
-
-            prodigal_thread = prodigal.ProdigalRunner(self.prodigal_folder, bin)
-            binname, selected_coding_table, c_density, \
-            v_N50, v_avg_gene_len, v_total_bases, v_cds_count, \
-            v_GC, v_totalContigs, v_maxContigLen = prodigal_thread.run(bin, ttable)
-
-            used_ttable[binname] = selected_coding_table
-            coding_density[binname] = c_density
-            N50[binname] = v_N50
-            avg_gene_len[binname] = v_avg_gene_len
-            total_bases[binname] = v_total_bases
-            GC[binname] = v_GC
-            cds_count[binname] = v_cds_count
-            totalContigs[binname] = v_totalContigs
-            maxContigLen[binname] = v_maxContigLen
-
-            queue_out.put((bin, selected_coding_table, coding_density, N50, avg_gene_len, total_bases, cds_count,
-                           GC, totalContigs, maxContigLen))
-
-    def __reportProgress(self, total_bins, queueIn):
-        """Report number of processed bins."""
+        general = np.asarray(general)
+        specific = np.asarray(specific)
+        difference = np.abs(general - specific)
 
-        processed = 0
+        additional_notes = np.full(len(difference), 'None', dtype=object)
+        divergent = ~((specific < 50) | (difference < threshold))
+        additional_notes[divergent] = ['Low confidence prediction - substantial ({}%) disagreement between completeness '
+                                       'prediction models'.format(int(d)) for d in difference[divergent]]
 
-        while True:
-            bin, selected_coding_table, coding_density, N50, \
-            avg_gene_len, total_bases, cds_count, GC, totalContigs, maxContigLen = queueIn.get(block=True, timeout=None)
-            if bin == None:
-                if logging.root.level == logging.INFO or logging.root.level == logging.DEBUG:
-                    sys.stdout.write('\n')
-                    sys.stdout.flush()
-                break
+        return additional_notes
 
-            processed += 1
+    def __load_models_in_background(self):
+        '''Start loading the models in a background thread, so they load while DIAMOND runs.
 
-            if logging.root.level == logging.INFO or logging.root.level == logging.DEBUG:
-                statusStr = '    Finished processing %d of %d (%.2f%%) bins.' % (
-                    processed, total_bins, float(processed) * 100 / total_bins)
-                sys.stdout.write('\r{}'.format(statusStr))
-                sys.stdout.flush()
+        Only call this once all worker processes have been forked: forked workers would otherwise carry copies
+        of the models, and TensorFlow isn't safe to fork once loaded.
+        '''
 
-    def __run_prodigal(self, ttable):
+        if self.__model_loader is not None:
+            return
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.__model_loader = executor.submit(modelProcessing.modelProcessor, self.total_threads)
+        executor.shutdown(wait=False)
+
+    def __wait_for_models(self):
+        self.__load_models_in_background()
+
+        if not self.__model_loader.done():
+            logging.info('Waiting for models to finish loading.')
+        start = time.time()
+        # re-raises the SystemExit of models that could not be loaded
+        modelProc = self.__model_loader.result()
+        logging.debug('Waited {:.2f} s for models to load.'.format(time.time() - start))
+
+        return modelProc
+
+    def __run_in_pool(self, worker, items, description):
+        """Run worker over items in a pool of processes, returning one result per item.
+
+        Results are handed straight back to the parent process as they complete, which also drives
+        the progress report, so no shared state has to be kept between worker processes.
+        """
+
+        results = []
+        total = len(items)
+        with mp.Pool(processes=min(self.total_threads, total)) as pool:
+            try:
+                for result in pool.imap_unordered(worker, items):
+                    results.append(result)
+                    self.__report_progress(len(results), total, description)
+            except Exception as e:
+                logging.error('An error occured while processing {}: {}'.format(description, e))
+                sys.exit(1)
 
-        self.threads_per_bin = max(1, int(self.total_threads / len(self.bin_files)))
-        logging.info("Calling genes in {} bins with {} threads:".format(len(self.bin_files), self.total_threads))
+        if logging.root.level == logging.INFO or logging.root.level == logging.DEBUG:
+            sys.stdout.write('\n')
+            sys.stdout.flush()
 
-        # process each bin in parallel
-        workerQueue = mp.Queue()
-        writerQueue = mp.Queue()
+        return results
 
-        for bin in self.bin_files:
-            workerQueue.put(bin)
+    def __report_progress(self, processed, total_bins, description):
+        """Report number of processed bins."""
 
-        for _ in range(self.total_threads):
-            workerQueue.put(None)
+        if logging.root.level == logging.INFO or logging.root.level == logging.DEBUG:
+            statusStr = '    Finished processing %d of %d (%.2f%%) %s.' % (
+                processed, total_bins, float(processed) * 100 / total_bins, description)
+            sys.stdout.write('\r{}'.format(statusStr))
+            sys.stdout.flush()
 
-        used_ttables = mp.Manager().dict()
-        coding_density = mp.Manager().dict()
-        N50 = mp.Manager().dict()
-        avg_gene_len = mp.Manager().dict()
-        total_bases = mp.Manager().dict()
-        cds_count = mp.Manager().dict()
-        GC = mp.Manager().dict()
-        totalContigs = mp.Manager().dict()
-        maxContigLen = mp.Manager().dict()
+    def __run_prodigal(self, jobs):
 
+        logging.info("Calling genes in {} bins with {} threads:".format(len(jobs), self.total_threads))
 
-        try:
-            calcProc = []
-            for _ in range(self.total_threads):
-                calcProc.append(
-                    mp.Process(target=self.__set_up_prodigal_thread, args=(workerQueue, writerQueue, ttable,
-                                                                           used_ttables, coding_density,
-                                                                           N50, avg_gene_len,
-                                                                           total_bases, cds_count, GC, totalContigs, maxContigLen)))
-            writeProc = mp.Process(target=self.__reportProgress, args=(len(self.bin_files), writerQueue))
+        return self.__run_in_pool(partial(_call_genes, self.prodigal_folder, self.gene_files_folder, self.debug_ttable,
+                                          self.ttable_prescreen), jobs, 'bins')
 
-            writeProc.start()
+    def __build_stats_table(self, records):
+        genome_stats = pd.DataFrame.from_records(records, columns=GENOME_STATS_COLUMNS)
+        genome_stats.set_index('Name', inplace=True)
 
-            for p in calcProc:
-                p.start()
+        return genome_stats
 
-            for p in calcProc:
-                p.join()
+    def __calculate_metadata(self, faa_files):
 
-            writerQueue.put((None, None, None, None, None, None, None, None, None, None))
-            writeProc.join()
-        except:
-            # make sure all processes are terminated
-            for p in calcProc:
-                p.terminate()
+        logging.info("Calculating metadata for {} bins with {} threads:".format(len(faa_files), self.total_threads))
 
-            writeProc.terminate()
+        return self.__run_in_pool(_calculate_metadata, faa_files, 'bin metadata')
 
-        return used_ttables, coding_density, N50, avg_gene_len, total_bases, cds_count, GC, totalContigs, maxContigLen
+    def __build_metadata_table(self, records):
 
-    def __calculate_metadata(self, faa_files):
+        # keep genome order independent of the order in which workers finished
+        records.sort(key=lambda record: record[0])
 
-        self.threads_per_bin = max(1, int(self.total_threads / len(faa_files)))
-        logging.info("Calculating metadata for {} bins with {} threads:".format(len(faa_files), self.total_threads))
+        metadata_df = pd.DataFrame({'Name': [record[0] for record in records],
+                                    'CDS': [record[1] for record in records],
+                                    'AALength': [record[2] for record in records]})
+        for idx, aa in enumerate(metadata.MetadataCalculator.amino_acids):
+            metadata_df[aa] = [record[3][idx] for record in records]
+
+        return metadata_df
+
+    def __run_streaming_pipeline(self, jobs, diamond_search):
+        '''Overlap gene calling and metadata calculation with DIAMOND annotation.
+
+        As soon as DIAMOND_DEFAULT_CHUNK_SIZE protein files are ready they are annotated in the background,
+        while the remaining bins are still being called. The threads are split between the two stages while
+        both are running; chunks started after gene calling has finished get all threads.
+        '''
+
+        diamond_threads = max(1, self.total_threads // 2)
+        prodigal_threads = max(1, self.total_threads - diamond_threads)
 
-        # process each bin in parallel
-        workerQueue = mp.Queue()
-        writerQueue = mp.Queue()
+        logging.info("Calling genes in {} bins with {} threads while annotating with DIAMOND using {} threads:"
+                     .format(len(jobs), prodigal_threads, diamond_threads))
 
-        for faa in faa_files:
-            workerQueue.put(faa)
+        # the size of streamed chunks isn't known in advance
+        diamond_search.plan([])
 
-        for _ in range(self.total_threads):
-            workerQueue.put(None)
+        gene_calling_done = threading.Event()
 
-        metadata_dict = mp.Manager().dict()
+        def annotate_chunk(protein_files, number):
+            threads = self.total_threads if gene_calling_done.is_set() else diamond_threads
+            return diamond_search.run_chunk(protein_files, number, threads)
 
+        stats_records, metadata_records, diamond_jobs, ready = [], [], [], []
+        worker = partial(_call_genes_and_metadata, self.prodigal_folder, self.gene_files_folder, self.debug_ttable,
+                         self.ttable_prescreen)
+
+        diamond_executor = ThreadPoolExecutor(max_workers=1)
         try:
-            calcProc = []
-            for _ in range(self.total_threads):
-                calcProc.append(
-                    mp.Process(target=self.__set_up_metadata_thread, args=(workerQueue, writerQueue, metadata_dict)))
-            writeProc = mp.Process(target=self.__report_progress_metadata, args=(len(faa_files), writerQueue))
+            # the pool forks its workers before the first DIAMOND thread is started
+            with mp.Pool(processes=min(prodigal_threads, len(jobs))) as pool:
+                try:
+                    for stats_record, metadata_record, protein_file in pool.imap_unordered(worker, jobs):
+                        stats_records.append(stats_record)
+                        self.__report_progress(len(stats_records), len(jobs), 'bins')
+
+                        # empty protein files are reported and dropped by verify_prodigal_output
+                        if metadata_record is not None:
+                            metadata_records.append(metadata_record)
+                            ready.append(protein_file)
+
+                        if len(ready) == diamond_search.chunksize:
+                            diamond_jobs.append(diamond_executor.submit(annotate_chunk, ready, len(diamond_jobs)))
+                            ready = []
+                except Exception as e:
+                    logging.error('An error occured while processing bins: {}'.format(e))
+                    sys.exit(1)
+
+            gene_calling_done.set()
 
-            writeProc.start()
+            if logging.root.level == logging.INFO or logging.root.level == logging.DEBUG:
+                sys.stdout.write('\n')
+                sys.stdout.flush()
 
-            for p in calcProc:
-                p.start()
+            if len(ready) > 0:
+                diamond_jobs.append(diamond_executor.submit(annotate_chunk, ready, len(diamond_jobs)))
 
-            for p in calcProc:
-                p.join()
+            # the pool has been closed, so no more workers are forked and models can load while DIAMOND finishes
+            self.__load_models_in_background()
 
-            writerQueue.put((None, None))
-            writeProc.join()
-        except:
-            # make sure all processes are terminated
-            for p in calcProc:
-                p.terminate()
+            logging.info('Gene calling finished. Waiting for DIAMOND annotation of {} chunk(s) to finish.'
+                         .format(len(diamond_jobs)))
+            diamond_out = [job.result() for job in diamond_jobs]
+        finally:
+            # on errors, don't start DIAMOND chunks that are still queued or wait for the one that is running
+            diamond_executor.shutdown(wait=False, cancel_futures=True)
 
-            writeProc.terminate()
+        if len(diamond_out) == 0:
+            logging.error("Error: DIAMOND failed to generate output.")
+            sys.exit(1)
 
-        # metadata_dict = process into df (metadata_dict)
-        return metadata_dict
+        return stats_records, metadata_records, diamond_out
 
-    def __set_up_metadata_thread(self, queue_in, queue_out, metadata_dict):
+    def __check_genome_cache(self, cache, ttable):
+        '''Look up all bins in the genome cache and return the bins that still need gene calling.
 
-        while True:
-            bin = queue_in.get(block=True, timeout=None)
-            if bin == None:
-                break
+        Bins with cached predictions skip the workflow entirely, bins with cached KO counts only go through
+        the models, and bins with only a cached translation table are called with that table alone.
+        '''
 
-            metadata_thread = metadata.MetadataCalculator(bin)
-            name1, cdscount_series = metadata_thread.calculate_CDS()
-            name2, aalength_series = metadata_thread.calculate_amino_acid_length()
-            name3, aa_list, aa_counts = metadata_thread.calculate_amino_acid_counts()
+        logging.info('Checking genome cache at {} for {} bins:'.format(cache.cache_dir, len(self.bin_files)))
+        keys = dict(self.__run_in_pool(partial(_genome_key, cache), self.bin_files, 'bin checksums'))
+
+        cached = {'keys': {}, 'genes': {}, 'kos': {}, 'predictions': {}}
+        jobs = []
+        cached_ttables = 0
+
+        for bin_file in self.bin_files:
+            key = keys[bin_file]
+            name = os.path.splitext(os.path.basename(bin_file))[0]
+            cached['keys'][name] = key
+
+            genes = cache.get(key, 'genes')
+            if genes is None:
+                jobs.append((bin_file, ttable))
+                continue
+
+            # the same sequence may have been cached under a different file name
+            genes['stats'][0] = name
+            genes['metadata'][0] = name
+
+            predictions = cache.get(key, 'predictions')
+            if predictions is not None:
+                cached['genes'][name] = genes
+                cached['predictions'][name] = predictions
+                continue
+
+            KO_counts = cache.get(key, 'kos')
+            if KO_counts is not None:
+                cached['genes'][name] = genes
+                cached['kos'][name] = KO_counts
+                continue
+
+            jobs.append((bin_file, genes['stats'][1]))
+            cached_ttables += 1
+
+        logging.info('Genome cache: {} bins with cached predictions, {} with cached annotations, '
+                     '{} with a cached translation table, {} not cached.'.format(
+                      len(cached['predictions']), len(cached['kos']), cached_ttables, len(jobs) - cached_ttables))
+
+        return jobs, cached
+
+    def __store_genes(self, cache, cached, stats_records, metadata_records):
+        metadata_by_name = dict((record[0], record) for record in metadata_records)
+        for record in stats_records:
+            # genomes without any predicted proteins are not cached
+            if record[0] in metadata_by_name:
+                cache.put(cached['keys'][record[0]], 'genes', {'stats': record, 'metadata': metadata_by_name[record[0]]})
+
+    def __store_KO_counts(self, cache, cached, protein_files, KO_matrix, genome_names, KO_list):
+        rows = dict((name, idx) for idx, name in enumerate(genome_names))
+        for protein_file in protein_files:
+            name = os.path.splitext(os.path.basename(protein_file))[0]
+            KO_counts = {}
+            if name in rows:
+                row = KO_matrix.getrow(rows[name])
+                KO_counts = dict((KO_list[column], int(count)) for column, count in zip(row.indices, row.data))
+            cache.put(cached['keys'][name], 'kos', KO_counts)
+
+    def __feature_names(self):
+        KeggCalc = keggData.KeggCalculator()
+        return [feature for category in ['Metadata', 'KO_Genes', 'KO_Pathways', 'KO_Modules', 'KO_Categories']
+                for feature in KeggCalc.return_proper_order(category)]
 
-            if name1 == name2 == name3:
-                meta_thread_df = pd.DataFrame(
-                    {'Name': [name1], 'CDS': [cdscount_series], 'AALength': [aalength_series]})
-                for idx, aa in enumerate(aa_list):
-                    meta_thread_df[aa] = aa_counts[idx]
-            else:
-                logging.error('Inconsistent name information in metadata calculation. Exiting.')
-                sys.exit(1)
+    def __merge_cached_predictions(self, cache, cached, names, final_comps, final_conts, models_chosen, csm_arrays,
+                                   general_results_comp, specific_results_comp):
 
-            metadata_dict[bin] = meta_thread_df
+        predictions = pd.DataFrame({'Name': names, 'Completeness': final_comps, 'Contamination': final_conts,
+                                    'Model': models_chosen, 'Cosine_Similarity': csm_arrays,
+                                    'General': general_results_comp, 'Specific': specific_results_comp})
 
-            queue_out.put(bin)
+        for record in predictions.to_dict(orient='records'):
+            cache.put(cached['keys'][record.pop('Name')], 'predictions', record)
 
-    def __report_progress_metadata(self, total_bins, queueIn):
-        """Report number of processed bins."""
+        if len(cached['predictions']) > 0:
+            cached_predictions = pd.DataFrame.from_dict(cached['predictions'], orient='index')
+            cached_predictions['Name'] = cached_predictions.index
+            predictions = pd.concat([predictions, cached_predictions[predictions.columns]])
+            predictions.sort_values(by='Name', inplace=True)
 
-        processed = 0
+        return predictions['Name'].tolist(), predictions['Completeness'].tolist(), \
+               predictions['Contamination'].tolist(), predictions['Model'].tolist(), \
+               predictions['Cosine_Similarity'].tolist(), predictions['General'].tolist(), \
+               predictions['Specific'].tolist()
 
-        while True:
-            bin = queueIn.get(block=True, timeout=None)
-            if bin[0] == None:
-                if logging.root.level == logging.INFO or logging.root.level == logging.DEBUG:
-                    sys.stdout.write('\n')
-                    sys.stdout.flush()
-                break
 
-            processed += 1
+''' Per-genome workers for the process pools in Predictor. These live at module level so they can be
+    sent to worker processes, and return plain records rather than writing into shared objects.'''
 
-            if logging.root.level == logging.INFO or logging.root.level == logging.DEBUG:
-                statusStr = '    Finished processing %d of %d (%.2f%%) bin metadata.' % (
-                    processed, total_bins, float(processed) * 100 / total_bins)
-                sys.stdout.write('\r{}'.format(statusStr))
-                sys.stdout.flush()
+def _call_genes(prodigal_folder, gene_files_folder, debug_ttable, ttable_prescreen, job):
+    bin_file, ttable = job
+    try:
+        prodigal_thread = prodigal.ProdigalRunner(prodigal_folder, bin_file, gene_files_folder)
+        return prodigal_thread.run(bin_file, ttable, debug_ttable, ttable_prescreen)
+    except SystemExit:
+        raise RuntimeError('gene calling failed for bin {}'.format(bin_file))
+
+
+def _genome_key(cache, bin_file):
+    return bin_file, cache.genome_key(bin_file)
+
+
+def _calculate_metadata(faa_file):
+    metadata_thread = metadata.MetadataCalculator(faa_file)
+    name1, cdscount_series = metadata_thread.calculate_CDS()
+    name2, aalength_series = metadata_thread.calculate_amino_acid_length()
+    name3, aa_list, aa_counts = metadata_thread.calculate_amino_acid_counts()
+
+    if not name1 == name2 == name3:
+        raise RuntimeError('inconsistent name information in metadata calculation for {}'.format(faa_file))
+
+    return name1, cdscount_series, aalength_series, aa_counts
+
+
+def _call_genes_and_metadata(prodigal_folder, gene_files_folder, debug_ttable, ttable_prescreen, job):
+    stats_record = _call_genes(prodigal_folder, gene_files_folder, debug_ttable, ttable_prescreen, job)
+    protein_file = os.path.join(prodigal_folder, '{}.faa'.format(stats_record[0]))
+
+    if not os.path.exists(protein_file) or os.stat(protein_file).st_size == 0:
+        return stats_record, None, protein_file
+
+    return stats_record, _calculate_metadata(protein_file), protein_file
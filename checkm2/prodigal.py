@@ -8,6 +8,7 @@ import shutil
 import gzip
 import tempfile
 
+from checkm2.defaultValues import DefaultValues
 from checkm2 import sequenceClasses
 from checkm2 import fileManager
 
@@ -20,7 +21,7 @@ from checkm2 import fileManager
 class ProdigalRunner():
     """Wrapper for running prodigal."""
 
-    def __init__(self, out_dir, bin_file):
+    def __init__(self, out_dir, bin_file, gene_files_dir=None):
 
         self.file_basename = os.path.splitext(os.path.basename(bin_file))[0]
 
@@ -28,30 +29,115 @@ class ProdigalRunner():
         self.checkForProdigal()
         self.faa_directory = out_dir
 
+        # nucleotide gene sequences and GFF output are only written if they are kept in gene_files_dir
+        self.gene_files_dir = gene_files_dir
+        gene_files_dir = out_dir if gene_files_dir is None else gene_files_dir
+
         self.aaGeneFile = os.path.join(out_dir, "{}{}".format(self.file_basename, '.faa'))
-        self.ntGeneFile = os.path.join(out_dir,  "{}{}".format(self.file_basename, '.fna'))
-        self.gffFile = os.path.join(out_dir,  "{}{}".format(self.file_basename, '.gff'))
+        self.ntGeneFile = os.path.join(gene_files_dir,  "{}{}".format(self.file_basename, '.fna'))
+        self.gffFile = os.path.join(gene_files_dir,  "{}{}".format(self.file_basename, '.gff'))
 
     def __calculate_N50(self, list_of_lengths):
+        # median length of the contig each base is on, found from the cumulative lengths of the sorted contigs
+        # rather than from a list with one entry per base
 
-        if np.array(list_of_lengths).mean() == 0:
+        lengths = np.sort(np.asarray(list_of_lengths, dtype=np.int64))
+        cumulative_lengths = np.cumsum(lengths)
+        total = int(cumulative_lengths[-1]) if len(lengths) > 0 else 0
+        if total == 0:
             return 0
 
-        tmp = []
-        for tmp_number in set(list_of_lengths):
-            tmp += [tmp_number] * list_of_lengths.count(tmp_number) * tmp_number
-        tmp.sort()
+        def length_at(base):
+            return int(lengths[np.searchsorted(cumulative_lengths, base, side='right')])
 
-        if (len(tmp) % 2) == 0:
-            median = (tmp[int(len(tmp) / 2) - 1] + tmp[int(len(tmp) / 2)]) / 2
+        if (total % 2) == 0:
+            median = (length_at(total // 2 - 1) + length_at(total // 2)) / 2
         else:
-            median = tmp[int(len(tmp) / 2)]
+            median = length_at(total // 2)
 
         return median
 
+    def __genome_statistics(self, sequence_file):
+        # length, G+C and A+T counts of every contig in a single pass over the file; contigs with the same name
+        # are counted once, as the last of them
+
+        contigs = {}
+        for seqId, length, counts in sequenceClasses.SeqFileReader(sequence_file).compositions('GCgcATat'):
+            contigs[seqId] = (length, int(counts[:4].sum()), int(counts[4:].sum()))
+
+        statistics = np.array(list(contigs.values()), dtype=np.int64).reshape(-1, 3)
+        return list(contigs.keys()), statistics[:, 0], int(statistics[:, 1].sum()), int(statistics[:, 2].sum())
+
+
+    def __callProdigal(self, arguments, gffFile, keepGenes=False):
+        """Run prodigal and parse its GFF output, read straight from its stdout unless it is kept in gffFile."""
+
+        try:
+            if gffFile is None:
+                with subprocess.Popen(arguments, stdout=subprocess.PIPE, universal_newlines=True) as process:
+                    return ProdigalGeneFeatureParser(process.stdout, keepGenes)
+
+            with open(gffFile, 'w') as gff:
+                subprocess.call(arguments, stdout=gff)
+            return ProdigalGeneFeatureParser(gffFile, keepGenes)
+        except OSError as e:
+            logging.error('An error occured while running prodigal: {}'.format(e))
+            sys.exit(1)
+
+    def __readthroughCodingBases(self, prodigalParser, sequence_file):
+        # bases that table 4 genes could add to the coding bases of table 11, where TGA codes for tryptophan
+        # rather than ending genes: the whole open reading frame of table 4 (between TAA and TAG stop codons) around
+        # every table 11 gene that ends with a TGA codon
 
-    def run(self, query, supplied_coding_table=None):
-        bNucORFs = True
+        T, A, G, C = b'TAGC'
+        gainedBases = 0
+        seen = set()
+        for seqId, seq, _ in sequenceClasses.SeqFileReader(sequence_file).records():
+            if seqId not in prodigalParser.genes or seqId in seen:
+                continue
+            seen.add(seqId)
+
+            bases = np.frombuffer(seq.upper().encode(), dtype=np.uint8)
+            if len(bases) < 3:
+                continue
+            first, second, third = bases[:-2], bases[1:-1], bases[2:]
+            # codons starting at each position, on the forward strand and as reverse complements
+            forwardStops = (first == T) & (second == A) & ((third == A) | (third == G))
+            reverseStops = ((first == T) | (first == C)) & (second == T) & (third == A)
+            forwardTGA = (first == T) & (second == G) & (third == A)
+            reverseTGA = (first == T) & (second == C) & (third == A)
+
+            # genes cover positions start to end of the coding base mask, so their stop codons start at position
+            # end - 4 of the sequence (forward strand) or start - 1 (reverse strand)
+            starts, ends, forward = prodigalParser.genes[seqId]
+            orfStarts, orfEnds = [], []
+            for strand, stopCodons, stops, TGA, stopOffset in ((True, ends - 4, forwardStops, forwardTGA, 3),
+                                                               (False, starts - 1, reverseStops, reverseTGA, 0)):
+                stopCodons = stopCodons[(forward == strand) & (stopCodons >= 0) & (stopCodons < len(TGA))]
+                stopCodons = stopCodons[TGA[stopCodons]]
+                for frame in range(3):
+                    frameCodons = stopCodons[stopCodons % 3 == frame]
+                    if len(frameCodons) == 0:
+                        continue
+                    # reading frames run from one stop codon to the next, ending with (forward strand) or starting
+                    # with (reverse strand) the stop codon, or up to the ends of the sequence
+                    frameEnd = frame + 3 * ((len(bases) - frame) // 3)
+                    frameStops = np.nonzero(stops[frame::3])[0] * 3 + frame + stopOffset
+                    boundaries = np.concatenate([[frame], frameStops, [frameEnd]])
+                    orfs = np.unique(np.searchsorted(boundaries, frameCodons, side='right') - 1)
+                    # positions of the coding base mask are one more than sequence positions
+                    orfStarts.append(boundaries[orfs] + 1)
+                    orfEnds.append(boundaries[orfs + 1] + 1)
+
+            codingStarts, codingEnds = prodigalParser.codingIntervals[seqId]
+            mergedStarts, mergedEnds = ProdigalGeneFeatureParser.mergeIntervals(
+                np.concatenate([codingStarts] + orfStarts), np.concatenate([codingEnds] + orfEnds))
+            gainedBases += int((mergedEnds - mergedStarts).sum() - (codingEnds - codingStarts).sum())
+
+        return gainedBases
+
+    def run(self, query, supplied_coding_table=None, debug_ttable=False, ttable_prescreen=False):
+        bNucORFs = self.gene_files_dir is not None
         prodigal_input = query
                   
         # decompress archive input files                
@@ -62,18 +148,8 @@ class ProdigalRunner():
                 with open(prodigal_input, 'wb') as f_out:
                     shutil.copyfileobj(f_in, f_out)
                 
-        seqs = sequenceClasses.SeqReader().read_nucleotide_sequences(prodigal_input)
-
-        totalBases = 0
-
-        contig_lengths = []
-        GC = 0
-        AT = 0
-        for seqId, seq in seqs.items():
-            totalBases += len(seq)
-            contig_lengths.append(len(seq))
-            GC += sum(seq.upper().count(x) for x in ("G", "C"))
-            AT += sum(seq.upper().count(x) for x in ("A", "T"))
+        seqIds, contig_lengths, GC, AT = self.__genome_statistics(prodigal_input)
+        totalBases = int(contig_lengths.sum())
 
         GC = float(GC/(AT + GC + 1))
 
@@ -81,12 +157,16 @@ class ProdigalRunner():
         tableCodingDensity = {}
 
         if supplied_coding_table is None:
-            ttables_to_check = [4, 11]
+            ttables_to_check = [11, 4]
         else:
             ttables_to_check = [supplied_coding_table]
 
-
+        ttables_checked = []
         for translationTable in ttables_to_check:
+            ttables_checked.append(translationTable)
+            # genes of table 11 are needed to screen whether table 4 could be chosen
+            screenTable4 = (ttable_prescreen or debug_ttable) and supplied_coding_table is None and \
+                translationTable == 11
             aaGeneFile = self.aaGeneFile + '.' + str(translationTable)
             ntGeneFile = self.ntGeneFile + '.' + str(translationTable)
             gffFile = self.gffFile + '.' + str(translationTable)
@@ -98,38 +178,26 @@ class ProdigalRunner():
                 procedureStr = 'single'  # estimate parameters from data
 
             if bNucORFs:
-                cmd = ('prodigal -p %s -q -m -f gff -g %d -a %s -d %s -i %s > %s' % (procedureStr,
-                                                                                                  translationTable,
-                                                                                                  aaGeneFile,
-                                                                                                  ntGeneFile,
-                                                                                                  prodigal_input,
-                                                                                                  gffFile))
+                cmd = ['prodigal', '-p', procedureStr, '-q', '-m', '-f', 'gff', '-g', str(translationTable),
+                       '-a', aaGeneFile, '-d', ntGeneFile, '-i', prodigal_input]
             else:
-                cmd = ('prodigal -p %s -q -m -f gff -g %d -a %s -i %s > %s' % (procedureStr,
-                                                                                            translationTable,
-                                                                                            aaGeneFile,
-                                                                                            prodigal_input,
-                                                                                            gffFile))
-            os.system(cmd)
+                cmd = ['prodigal', '-p', procedureStr, '-q', '-m', '-f', 'gff', '-g', str(translationTable),
+                       '-a', aaGeneFile, '-i', prodigal_input]
+            prodigalParser = self.__callProdigal(cmd, gffFile if bNucORFs else None, screenTable4)
 
             if not self.__areORFsCalled(aaGeneFile) and procedureStr == 'single':
                 # prodigal will fail to learn a model if the input genome has a large number of N's
                 # so try gene prediction with 'meta'
-                cmd = cmd.replace('-p single', '-p meta')
-                try:
-                    os.system(cmd)
-                except Exception as e:
-                    logging.error('An error occured while running prodigal: {}'.format(e))
-                    sys.exit(1)
+                cmd[cmd.index('single')] = 'meta'
+                prodigalParser = self.__callProdigal(cmd, gffFile if bNucORFs else None, screenTable4)
 
             # determine coding density
-            prodigalParser = ProdigalGeneFeatureParser(gffFile)
 
             codingBases = 0
 
 
 
-            for seqId, seq in seqs.items():
+            for seqId in seqIds:
                 codingBases += prodigalParser.codingBases(seqId)
 
             if totalBases != 0:
@@ -138,44 +206,62 @@ class ProdigalRunner():
                 codingDensity = 0
             tableCodingDensity[translationTable] = codingDensity
 
+            if screenTable4:
+                # table 4 is only called if table 11 finds few coding bases, or if reading through TGA codons could
+                # raise coding density enough for table 4 to be chosen below; table 11 cuts the genes of table 4
+                # genomes short at the TGA codons they contain
+                readthroughDensity = codingDensity
+                if totalBases != 0:
+                    readthroughDensity += self.__readthroughCodingBases(prodigalParser, prodigal_input) / totalBases
+                table4Screened = codingDensity < DefaultValues.TTABLE_SCREEN_CODING_DENSITY or \
+                    (readthroughDensity - codingDensity > 0.05 - DefaultValues.TTABLE_SCREEN_MARGIN and
+                     readthroughDensity > 0.7 - DefaultValues.TTABLE_SCREEN_MARGIN)
+                if not table4Screened and not debug_ttable:
+                    break
+
         # determine best translation table
 
         if supplied_coding_table is not None:
             bestTranslationTable = supplied_coding_table
         else:
             bestTranslationTable = 11
-            if (tableCodingDensity[4] - tableCodingDensity[11] > 0.05) and tableCodingDensity[4] > 0.7:
+            if 4 in tableCodingDensity and (tableCodingDensity[4] - tableCodingDensity[11] > 0.05) and \
+                    tableCodingDensity[4] > 0.7:
                 bestTranslationTable = 4
 
-
-        shutil.copyfile(self.aaGeneFile + '.' + str(bestTranslationTable), self.aaGeneFile)
-        shutil.copyfile(self.gffFile + '.' + str(bestTranslationTable), self.gffFile)
-        if bNucORFs:
-            shutil.copyfile(self.ntGeneFile + '.' + str(bestTranslationTable), self.ntGeneFile)
-
-        # clean up redundant prodigal results
-        for translationTable in ttables_to_check:
-            os.remove(self.aaGeneFile + '.' + str(translationTable))
-            os.remove(self.gffFile + '.' + str(translationTable))
-            if bNucORFs:
-                os.remove(self.ntGeneFile + '.' + str(translationTable))
-
-        os.remove(self.ntGeneFile)
-        os.remove(self.gffFile)
+            if debug_ttable:
+                screenedTranslationTable = bestTranslationTable if table4Screened else 11
+                logging.info('Translation table pre-screen for {}: table 11 coding density {:.3f}, with TGA '
+                             'read-through {:.3f}, table 4 coding density {:.3f}; table {} screened, table {} chosen.'
+                             .format(self.file_basename, tableCodingDensity[11], readthroughDensity,
+                                     tableCodingDensity[4], 4 if table4Screened else 11, bestTranslationTable))
+                if screenedTranslationTable != bestTranslationTable:
+                    logging.warning('Translation table pre-screen would have chosen table {} instead of table {} '
+                                    'for {}.'.format(screenedTranslationTable, bestTranslationTable,
+                                                     self.file_basename))
+
+        # keep the results of the best translation table under their final names and clean up the others
+        gene_files = [self.aaGeneFile, self.gffFile, self.ntGeneFile] if bNucORFs else [self.aaGeneFile]
+        for translationTable in ttables_checked:
+            for gene_file in gene_files:
+                if translationTable == bestTranslationTable:
+                    os.replace(gene_file + '.' + str(translationTable), gene_file)
+                else:
+                    os.remove(gene_file + '.' + str(translationTable))
 
 
         gene_lengths = []
         cds_count = 0
-        aa_seqs = sequenceClasses.SeqReader().read_nucleotide_sequences(self.aaGeneFile)
-        for seqId, seq in aa_seqs.items():
-            gene_lengths.append(len(seq))
+        aa_lengths = dict(sequenceClasses.SeqFileReader(self.aaGeneFile).lengths())
+        for seqId, length in aa_lengths.items():
+            gene_lengths.append(length)
             cds_count += 1
 
 
 #        if prodigal_input.endswith('.gz'):
 #            shutil.rmtree(tmp_dir)
 
-        maxContigLen = np.array(contig_lengths).max()
+        maxContigLen = contig_lengths.max()
         totalContigs = len(contig_lengths)
 
         return self.file_basename, bestTranslationTable, tableCodingDensity[bestTranslationTable], \
@@ -225,24 +311,30 @@ class ProdigalFastaParser():
         return gp
 
 class ProdigalGeneFeatureParser():
-    """Parses prodigal FASTA output."""
+    """Parses prodigal GFF output, from a file name or an iterable of GFF lines such as prodigal's stdout.
 
-    def __init__(self, filename):
-        fileManager.check_if_file_exists(filename)
+    Only the merged coding intervals of each sequence are kept: genes are read one sequence at a time, and
+    overlapping genes are merged, so coding bases are counted without a mask of every base. With keepGenes, the
+    start, end and strand (True for forward) of every gene are kept as well."""
 
-        self.genes = {}
+    def __init__(self, gff, keepGenes=False):
+        self.codingIntervals = {}
         self.lastCodingBase = {}
+        self.keepGenes = keepGenes
+        self.genes = {}
 
-        self.__parseGFF(filename)
-
-        self.codingBaseMasks = {}
-        for seqId in self.genes:
-            self.codingBaseMasks[seqId] = self.__buildCodingBaseMask(seqId)
+        if isinstance(gff, str):
+            fileManager.check_if_file_exists(gff)
+            with open(gff) as gff_lines:
+                self.__parseGFF(gff_lines)
+        else:
+            self.__parseGFF(gff)
 
-    def __parseGFF(self, filename):
-        """Parse genes from GFF file."""
+    def __parseGFF(self, lines):
+        """Parse genes from GFF lines."""
         self.translationTable = None
-        for line in open(filename):
+        seqId, starts, ends, strands = None, [], [], []
+        for line in lines:
             if line.startswith('# Model Data') and not self.translationTable:
                 lineSplit = line.split(';')
                 for token in lineSplit:
@@ -256,41 +348,63 @@ class ProdigalGeneFeatureParser():
                 continue
 
             lineSplit = line.split('\t')
-            seqId = lineSplit[0]
-            if seqId not in self.genes:
-                geneCounter = 0
-                self.genes[seqId] = {}
-                self.lastCodingBase[seqId] = 0
+            if lineSplit[0] != seqId:
+                self.__addGenes(seqId, starts, ends, strands)
+                seqId, starts, ends, strands = lineSplit[0], [], [], []
+
+            # genes cover positions start to end of the coding base mask, as half-open intervals
+            starts.append(int(lineSplit[3]))
+            ends.append(int(lineSplit[4]) + 1)
+            strands.append(lineSplit[6] == '+')
+
+        self.__addGenes(seqId, starts, ends, strands)
+
+    def __addGenes(self, seqId, starts, ends, strands):
+        """Merge the genes of a sequence into its coding intervals."""
+
+        if len(starts) == 0:
+            return
 
-            geneId = seqId + '_' + str(geneCounter)
-            geneCounter += 1
+        starts = np.array(starts, dtype=np.int64)
+        ends = np.array(ends, dtype=np.int64)
+        if self.keepGenes:
+            genes = (starts, ends, np.array(strands, dtype=bool))
+            if seqId in self.genes:
+                genes = tuple(np.concatenate([kept, new]) for kept, new in zip(self.genes[seqId], genes))
+            self.genes[seqId] = genes
 
-            start = int(lineSplit[3])
-            end = int(lineSplit[4])
+        if seqId in self.codingIntervals:
+            starts = np.concatenate([self.codingIntervals[seqId][0], starts])
+            ends = np.concatenate([self.codingIntervals[seqId][1], ends])
 
-            self.genes[seqId][geneId] = [start, end]
-            self.lastCodingBase[seqId] = max(self.lastCodingBase[seqId], end)
+        self.codingIntervals[seqId] = self.mergeIntervals(starts, ends)
+        self.lastCodingBase[seqId] = int(ends.max()) - 1
 
-    def __buildCodingBaseMask(self, seqId):
-        """Build mask indicating which bases in a sequences are coding."""
+    @staticmethod
+    def mergeIntervals(starts, ends):
+        """Merge half-open intervals into sorted, non-overlapping ones."""
 
         # safe way to calculate coding bases as it accounts
-        # for the potential of overlapping genes
-        codingBaseMask = np.zeros(self.lastCodingBase[seqId])
-        for pos in self.genes[seqId].values():
-            codingBaseMask[pos[0]:pos[1] + 1] = 1
+        # for the potential of overlapping genes: an interval starts a new merged interval
+        # only if it begins after every interval before it has ended
+        order = np.argsort(starts, kind='stable')
+        starts, ends = starts[order], ends[order]
+        merged = np.ones(len(starts), dtype=bool)
+        merged[1:] = starts[1:] > np.maximum.accumulate(ends)[:-1]
+        merged_starts = np.nonzero(merged)[0]
 
-        return codingBaseMask
+        return starts[merged_starts], np.maximum.reduceat(ends, merged_starts)
 
     def codingBases(self, seqId, start=0, end=None):
         """Calculate number of coding bases in sequence between [start, end)."""
 
         # check if sequence has any genes
-        if seqId not in self.genes:
+        if seqId not in self.codingIntervals:
             return 0
 
-        # set end to last coding base if not specified
-        if end == None:
-            end = self.lastCodingBase[seqId]
+        # set end to last coding base if not specified; the mask of coding bases ends there
+        start, end, _ = slice(start, end).indices(self.lastCodingBase[seqId])
 
-        return np.sum(self.codingBaseMasks[seqId][start:end])
+        starts, ends = self.codingIntervals[seqId]
+        overlaps = np.minimum(ends, end) - np.maximum(starts, start)
+        return int(overlaps[overlaps > 0].sum())
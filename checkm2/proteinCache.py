@@ -0,0 +1,140 @@
+from checkm2.defaultValues import DefaultValues
+from checkm2 import fileManager
+
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+
+
+class ProteinAnnotationCache():
+
+    ''' Persistent protein sequence hash -> DIAMOND hit store, kept in a sqlite file.
+
+        Every entry records the checksum of the DIAMOND database and the DIAMOND thresholds that produced it,
+        so hits are never reused with a different database or different search settings. Proteins without
+        a hit are stored as well (with an empty hit) so they are not searched again either.
+
+        Database checksums are memoised per path, size and modification time, so the database is only hashed
+        once rather than on every run. The genome cache uses the same memo for the database and model files.
+    '''
+
+    # sqlite limits the number of host parameters per statement
+    BATCH_SIZE = 500
+
+    def __init__(self, cache_dir, diamond_location=None):
+        fileManager.make_sure_path_exists(cache_dir)
+        self.location = os.path.join(os.path.abspath(cache_dir), DefaultValues.PROTEIN_CACHE_FILE_NAME)
+
+        with self.__connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS hits (seq_hash TEXT NOT NULL, db_checksum TEXT NOT NULL, '
+                               'parameters TEXT NOT NULL, hit TEXT, last_used INTEGER NOT NULL, '
+                               'PRIMARY KEY (seq_hash, db_checksum, parameters))')
+            connection.execute('CREATE TABLE IF NOT EXISTS db_checksums (path TEXT NOT NULL, size INTEGER NOT NULL, '
+                               'mtime INTEGER NOT NULL, checksum TEXT NOT NULL, PRIMARY KEY (path, size, mtime))')
+        connection.close()
+
+        self.parameters = 'query-cover={};subject-cover={};id={};evalue={};max-target-seqs=1'.format(
+            DefaultValues.DIAMOND_QUERY_COVER, DefaultValues.DIAMOND_SUBJECT_COVER,
+            DefaultValues.DIAMOND_PERCENT_ID, DefaultValues.DIAMOND_EVALUE)
+
+        self.db_checksum = None
+        if diamond_location is not None:
+            self.db_checksum = self.file_checksum(diamond_location)
+
+    def __connect(self):
+        # DIAMOND chunks may be annotated from several threads, so every operation uses its own connection
+        return sqlite3.connect(self.location, timeout=600)
+
+    def file_checksum(self, location):
+        '''sha256 of a file, memoised per path, size and modification time.'''
+
+        path = os.path.abspath(location)
+        st = os.stat(path)
+
+        connection = self.__connect()
+        row = connection.execute('SELECT checksum FROM db_checksums WHERE path = ? AND size = ? AND mtime = ?',
+                                 (path, st.st_size, st.st_mtime_ns)).fetchone()
+        if row is None:
+            logging.info('Calculating checksum of {} for the CheckM2 cache.'.format(path))
+            sha256_hash = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for byte_block in iter(lambda: f.read(1 << 20), b""):
+                    sha256_hash.update(byte_block)
+            checksum = sha256_hash.hexdigest()
+            with connection:
+                connection.execute('INSERT OR REPLACE INTO db_checksums VALUES (?, ?, ?, ?)',
+                                   (path, st.st_size, st.st_mtime_ns, checksum))
+        else:
+            checksum = row[0]
+        connection.close()
+
+        return checksum
+
+    def lookup(self, seq_hashes):
+        '''Return a dict of sequence hash (hexadecimal sha256) -> DIAMOND hit for all cached hashes. Cached
+        proteins without a hit map to None; the hit is the DIAMOND tabular output line without its query column.'''
+
+        seq_hashes = list(seq_hashes)
+        found = {}
+        now = int(time.time())
+
+        connection = self.__connect()
+        with connection:
+            for i in range(0, len(seq_hashes), self.BATCH_SIZE):
+                batch = seq_hashes[i:i + self.BATCH_SIZE]
+                placeholders = ','.join('?' * len(batch))
+                rows = connection.execute('SELECT seq_hash, hit FROM hits WHERE db_checksum = ? AND parameters = ? '
+                                          'AND seq_hash IN ({})'.format(placeholders),
+                                          [self.db_checksum, self.parameters] + batch).fetchall()
+                found.update(rows)
+                connection.execute('UPDATE hits SET last_used = ? WHERE db_checksum = ? AND parameters = ? '
+                                   'AND seq_hash IN ({})'.format(placeholders),
+                                   [now, self.db_checksum, self.parameters] + batch)
+        connection.close()
+
+        return found
+
+    def store(self, hits):
+        '''Store a dict of sequence hash -> DIAMOND hit (None for proteins without a hit).'''
+
+        now = int(time.time())
+        connection = self.__connect()
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?, ?)',
+                                   ((seq_hash, self.db_checksum, self.parameters, hit, now)
+                                    for seq_hash, hit in hits.items()))
+        connection.close()
+
+    def stats(self):
+        connection = self.__connect()
+        entries, annotated = connection.execute('SELECT COUNT(*), COUNT(hit) FROM hits').fetchone()
+        connection.close()
+
+        logging.info('Protein annotation cache at {}'.format(self.location))
+        logging.info('    {} proteins ({} with a DIAMOND hit), {:.2f} MB'.format(
+            entries, annotated, os.path.getsize(self.location) / 1e6))
+
+    def prune(self, max_size_gb):
+        '''Evict least recently used proteins until the cache file is below max_size_gb.'''
+
+        max_size = max_size_gb * 1e9
+        size = os.path.getsize(self.location)
+        if size <= max_size:
+            return 0
+
+        connection = self.__connect()
+        entries = connection.execute('SELECT COUNT(*) FROM hits').fetchone()[0]
+        # entries are of similar size, so remove a proportional share of the oldest ones
+        to_remove = entries - int(entries * max_size / size)
+        with connection:
+            connection.execute('DELETE FROM hits WHERE rowid IN (SELECT rowid FROM hits ORDER BY last_used LIMIT ?)',
+                               (to_remove,))
+        connection.execute('VACUUM')
+        connection.close()
+
+        logging.info('Evicted {} proteins from protein annotation cache; {:.2f} MB remaining.'.format(
+            to_remove, os.path.getsize(self.location) / 1e6))
+
+        return to_remove
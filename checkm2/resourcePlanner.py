@@ -0,0 +1,106 @@
+from checkm2.defaultValues import DefaultValues
+
+import os
+import math
+import logging
+
+
+class ResourcePlanner():
+
+    ''' Works out DIAMOND and inference settings from a memory budget.
+
+        Without a memory limit, the original settings are used: one DIAMOND chunk at a time with all threads and
+        a --block-size of 2 (0.5 in low-memory mode) with DIAMOND's default number of index chunks, and feature
+        vectors built for KO_FEATURE_VECTOR_CHUNK genomes at a time. Memory that merely looks free is not
+        assumed to be available to CheckM2, so chunks only run concurrently with a memory limit.
+
+        With a memory limit, the limit (less the memory kept for the models) is split between concurrent DIAMOND
+        chunks, and each chunk gets the largest block size that fits. Larger blocks mean fewer passes over the
+        database; once a whole database fits in a single block, leftover memory goes to fewer index chunks instead.
+        Memory use is estimated from the DIAMOND manual (roughly 6 GB per unit of block size with 4 index chunks),
+        so limits should leave some headroom.
+    '''
+
+    def __init__(self, threads, diamond_location, lowmem=False, memory_limit=None):
+        self.threads = threads
+        self.lowmem = lowmem
+        self.memory_limit = memory_limit
+
+        # reference sequences make up nearly all of a .dmnd file, so its size bounds the useful block size
+        self.database_letters = os.path.getsize(diamond_location) if os.path.exists(diamond_location) else None
+
+    def __chunk_memory(self, block_size, index_chunks, query_residues):
+        # sequences of a chunk are held in memory on top of the block
+        return DefaultValues.DIAMOND_MEMORY_PER_BLOCK_SIZE_GB[index_chunks] * block_size * 1e9 + query_residues
+
+    def plan_diamond(self, chunk_residues, log=True):
+        '''Returns a dict with block_size, index_chunks (None for DIAMOND's default), concurrency and threads per
+        chunk for DIAMOND chunks of the given residue counts.'''
+
+        chunk_count = max(1, len(chunk_residues))
+        largest_chunk = max(chunk_residues) if len(chunk_residues) > 0 else 0
+        by_threads = max(1, self.threads // DefaultValues.DIAMOND_MIN_CHUNK_THREADS)
+
+        if self.memory_limit is None:
+            block_size = DefaultValues.DIAMOND_LOWMEM_BLOCK_SIZE if self.lowmem else DefaultValues.DIAMOND_DEFAULT_BLOCK_SIZE
+            index_chunks = None
+            concurrency = 1
+        else:
+            diamond_memory = (self.memory_limit - DefaultValues.MODEL_MEMORY_RESERVE_GB) * 1e9
+            max_block_size = DefaultValues.DIAMOND_MAX_BLOCK_SIZE
+            if self.database_letters is not None:
+                max_block_size = min(max_block_size, max(DefaultValues.DIAMOND_MIN_BLOCK_SIZE,
+                                                         math.ceil(self.database_letters / 1e8) / 10))
+
+            # run fewer chunks at once rather than shrinking their blocks below the default block size
+            concurrent_block_size = min(DefaultValues.DIAMOND_DEFAULT_BLOCK_SIZE, max_block_size)
+            concurrency = min(chunk_count, by_threads)
+            while concurrency > 1 and diamond_memory / concurrency < self.__chunk_memory(
+                    concurrent_block_size, DefaultValues.DIAMOND_DEFAULT_INDEX_CHUNKS, largest_chunk):
+                concurrency -= 1
+            memory_per_chunk = diamond_memory / concurrency
+
+            index_chunks = DefaultValues.DIAMOND_DEFAULT_INDEX_CHUNKS
+            block_size = (memory_per_chunk - largest_chunk) / \
+                         (DefaultValues.DIAMOND_MEMORY_PER_BLOCK_SIZE_GB[index_chunks] * 1e9)
+            block_size = max(DefaultValues.DIAMOND_MIN_BLOCK_SIZE, min(max_block_size, int(block_size * 10) / 10))
+            if block_size == DefaultValues.DIAMOND_MIN_BLOCK_SIZE and \
+                    self.__chunk_memory(block_size, index_chunks, largest_chunk) > memory_per_chunk:
+                logging.warning('A memory limit of {} GB is too low to run DIAMOND within it. '
+                                'Using the smallest block size of {}.'.format(self.memory_limit, block_size))
+
+            # spare memory once the whole database fits into a single block
+            if block_size == max_block_size:
+                for candidate in sorted(DefaultValues.DIAMOND_MEMORY_PER_BLOCK_SIZE_GB):
+                    if self.__chunk_memory(block_size, candidate, largest_chunk) <= memory_per_chunk:
+                        index_chunks = candidate
+                        break
+
+        plan = {'block_size': block_size,
+                'index_chunks': index_chunks,
+                'concurrency': concurrency,
+                'chunk_threads': max(1, self.threads // concurrency)}
+
+        if log:
+            logging.info('DIAMOND plan: {} chunk(s) of up to {:.1f} M residues, {} at a time with {} threads, '
+                         '--block-size {}, --index-chunks {}{}.'.format(
+                          chunk_count, largest_chunk / 1e6, plan['concurrency'], plan['chunk_threads'], block_size,
+                          'default' if index_chunks is None else index_chunks,
+                          '' if self.memory_limit is None else ' (memory limit {} GB)'.format(self.memory_limit)))
+
+        return plan
+
+    def plan_inference(self, genome_count):
+        '''Number of genomes to build feature vectors for at a time.'''
+
+        if self.memory_limit is None:
+            return DefaultValues.KO_FEATURE_VECTOR_CHUNK
+
+        inference_memory = (self.memory_limit - DefaultValues.MODEL_MEMORY_RESERVE_GB) * 1e9
+        chunk = int(inference_memory // (DefaultValues.FEATURE_VECTOR_MEMORY_MB * 1e6))
+        chunk = max(1, min(genome_count, chunk))
+
+        logging.info('Inference plan: feature vectors for {} genomes at a time (memory limit {} GB).'.format(
+            chunk, self.memory_limit))
+
+        return chunk
@@ -5,7 +5,6 @@ from checkm2 import version
 import os
 import hashlib
 from packaging import version as v_compare
-import pandas as pd
 import json
 import sys
 import logging
@@ -58,6 +57,9 @@ class VersionControl():
         return v_compare.parse(str(query)) >= v_compare.parse(str(ref))
 
     def return_highest_compatible_DB_version(self):
+        # pandas is slow to import, and isn't needed to start CheckM2
+        import pandas as pd
+
         version_hashes = os.path.join(DefaultValues.VERSION_PATH, 'version_hashes_{}.json'.format(version.__version__))
         try:
             version_hashes = pd.read_json(version_hashes)
@@ -73,6 +75,7 @@ class VersionControl():
 
     def checksum_version_validate(self):
         '''Runs each time to ensure all models, definitions and pickled files are congruent with current CheckM2 version'''
+        import pandas as pd
 
         version_hashes = os.path.join(DefaultValues.VERSION_PATH, 'version_hashes_{}.json'.format(version.__version__))
         try:
@@ -98,6 +101,7 @@ class VersionControl():
 
     def checksum_version_validate_DIAMOND(self, location=None):
         '''Runs to ensure DIAMOND database has correct checksum and is congruent with current CheckM2 version'''
+        import pandas as pd
 
         version_hashes = os.path.join(DefaultValues.VERSION_PATH,
                                       'version_hashes_{}.json'.format(version.__version__))
@@ -113,7 +117,11 @@ class VersionControl():
             database_dir = location
 
         dbhash = self.__calculate_checksum(database_dir, True)
-        
+
+        #pruned databases are validated through the database they were built from
+        pruned = [entry for entry in self.__read_pruned_registry().values() if entry['sha256'] == dbhash]
+        if len(pruned) > 0:
+            dbhash = pruned[0]['source_sha256']
 
         if dbhash in version_hashes['sha256'].values:
             cutoff_version = version_hashes[version_hashes["sha256"] == dbhash]['incompatible_below_checkm2ver'].values[-1]
@@ -122,4 +130,35 @@ class VersionControl():
             logging.error('One of the files CheckM2 relies on has an incorrect checksum. Please re-download CheckM2.')
             sys.exit(1)
 
-
+    def __read_pruned_registry(self):
+        try:
+            with open(DefaultValues.PRUNED_DB_REGISTRY) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def register_pruned_DIAMOND(self, pruned_location, source_location, source_letters):
+        '''Records the checksum of a pruned DIAMOND database together with the database it was built from'''
+
+        registry = self.__read_pruned_registry()
+        registry[os.path.abspath(pruned_location)] = {'sha256': self.__calculate_checksum(pruned_location, True),
+                                                      'size': os.path.getsize(pruned_location),
+                                                      'source_sha256': self.__calculate_checksum(source_location, True),
+                                                      'source_letters': source_letters}
+        with open(DefaultValues.PRUNED_DB_REGISTRY, 'w') as f:
+            json.dump(registry, f)
+
+    def return_pruned_DIAMOND_size(self, location):
+        '''Returns the number of letters of the full database a pruned database was built from, or None if the
+        database is not a registered pruned database. Matched by path, or by name and size if it was moved.'''
+
+        location = os.path.abspath(location)
+        if not os.path.exists(location):
+            return None
+        registry = self.__read_pruned_registry()
+        if location in registry:
+            return registry[location]['source_letters']
+        for path, entry in registry.items():
+            if os.path.basename(path) == os.path.basename(location) and entry['size'] == os.path.getsize(location):
+                return entry['source_letters']
+        return None